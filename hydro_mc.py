@@ -14,6 +14,19 @@ import numpy as np
 import argparse
 import sys
 import re
+import os
+import time
+import itertools
+import inspect
+import multiprocessing
+import tempfile
+import shutil
+import collections
+import json
+import math
+import contextlib
+import functools
+import mmap
 
 #start of fit parameters
 __mc_fit_parameters = {"vir": {"params": [1.503454114104443, -0.04283092691408333, 0.5157209989941997, 0.45445667750331026, -0.24856881467360964, 0.5544350140093234, -0.0048813484527866656, -0.12199409397642753, 0.11663423303800534, 0.05110946208460489, -0.07892747676338406, 0.24005903699741252, -0.1263499637381384, 0.6640188439939326, -0.0299567877892118, 0.3877956797872577], "pivots": {"M": 198759238503196.03, "a": 0.8771929824561403, "omega_m": 0.272, "omega_b": 0.0456, "sigma8": 0.809, "h0": 0.704}}, "200c": {"params": [1.2436364990990914, -0.04817261898156871, 0.20419215885982817, 0.6316820273466903, -0.24605297432854378, 0.560570072125268, -0.02627068018190943, -0.11775877953823762, 0.11193584169417208, 0.05634549061614718, -0.043822582719200295, 0.3524426183203193, -0.03879420539288709, 0.7673900896521332, -0.27569460666976725, 0.3843115348866266], "pivots": {"M": 173960723876953.16, "a": 0.8771929824561403, "omega_m": 0.272, "omega_b": 0.0456, "sigma8": 0.809, "h0": 0.704}}, "500c": {"params": [0.8637563855047179, -0.05344871238505832, 0.1878750841109432, 0.6618004570191556, -0.23490408373403376, 0.5190661049361811, -0.03143074979091932, -0.11241937064515797, 0.1257731196624856, 0.08805802745200282, -0.1563176516883163, 0.3463795016853568, -0.044602075614319794, 0.8564224417001306, -0.34652816060672165, 0.3765132317155449], "pivots": {"M": 137038782293146.31, "a": 0.8771929824561403, "omega_m": 0.272, "omega_b": 0.0456, "sigma8": 0.809, "h0": 0.704}}, "2500c": {"params": [0.12656051215719555, -0.03050866662392269, 0.10725429255827736, 0.7593881752986629, -0.27160211703510345, 0.42181074155295156, -0.020575075642635738, -0.1163991007298093, 0.28880298414213335, 0.10263452464907902, -0.34222932053193433, 0.3844570767051972, -0.1334171989405518, 0.8457199265161256, 0.0028417430312315424, 0.3827347978288253], "pivots": {"M": 68722326105291.2, "a": 0.8771929824561403, "omega_m": 0.272, "omega_b": 0.0456, "sigma8": 0.809, "h0": 0.704}}, "200m": {"params": [1.692410096240174, -0.040346034043160055, 0.9092242875122345, 0.2268328343963277, -0.2664240976376676, 0.5283845428748246, 0.015645163737334208, -0.11627375082296813, 0.11528658344781062, 0.05003254567973524, -0.09358485276497253, -0.04322554482713586, -0.06348838757477149, 0.6351347984085912, -0.40487997854959523, 0.3882554231750548], "pivots": {"M": 224397583007812.53, "a": 0.8771929824561403, "omega_m": 0.272, "omega_b": 0.0456, "sigma8": 0.809, "h0": 0.704}}}
@@ -40,6 +53,64 @@ def panic(x):
 def printf(x):
     sys.stdout.write(x+'\n')
 
+__profile = None
+
+@contextlib.contextmanager
+def profiling(stats=None, hook=None):
+    """ collects counters and timers of the conversions and of the NFW solvers called in the `with` block of the current process.
+        Yields a dict {name: counters}, where names are e.g. "mass_from_mc_relation 500c->vir" or "solver newton" and counters are
+        the number of calls and of elements, the time spent, the iterations, the unconverged elements, the worst residual and the range of concentrations.
+        If set, hook(name, counters) is called at every call with the counters of that call (e.g. to alert on unconverged elements).
+        Without profiling the only overhead is a check of a global variable. """
+    global __profile
+    previous = __profile
+    __profile = ({} if stats is None else stats, hook)
+    try:
+        yield __profile[0]
+    finally:
+        __profile = previous
+
+def profile_record(name, seconds=0., elements=0, iterations=0, unconverged=0, residual=0., c=None):
+    """ adds a call of `name` to the counters collected by `profiling` """
+    stats, hook = __profile
+    counters = {'calls': 1, 'seconds': seconds, 'elements': elements, 'iterations': iterations, 'unconverged': int(unconverged), 'residual': float(residual)}
+    if c is not None and np.size(c)>0:
+        counters['c_min'], counters['c_max'] = float(np.min(c)), float(np.max(c))
+    total = stats.setdefault(name, {'calls': 0, 'seconds': 0., 'elements': 0, 'iterations': 0, 'unconverged': 0, 'residual': 0.})
+    for key in ('calls', 'seconds', 'elements', 'iterations', 'unconverged'):
+        total[key] += counters[key]
+    total['residual'] = max(total['residual'], counters['residual'])
+    if 'c_min' in counters:
+        total['c_min'] = min(total.get('c_min', np.inf), counters['c_min'])
+        total['c_max'] = max(total.get('c_max', -np.inf), counters['c_max'])
+    hook and hook(name, counters)
+
+def profiled(*delta_names):
+    """ decorator that times the calls of a conversion while `profiling`, by the name of the function and its overdensities `delta_names` """
+    def decorator(function):
+        signature = inspect.signature(function)
+        @functools.wraps(function)
+        def wrapper(*args, **kw):
+            if __profile is None:
+                return function(*args, **kw)
+            start = time.perf_counter()
+            result = function(*args, **kw)
+            arguments = signature.bind(*args, **kw).arguments
+            name = ' '.join([function.__name__, '->'.join(str(arguments.get(delta)) for delta in delta_names)])
+            value = result[0] if isinstance(result, tuple) else result
+            profile_record(name, time.perf_counter()-start, elements=np.size(value) if not isinstance(value, dict) else np.size(arguments.get('M')))
+            return result
+        return wrapper
+    return decorator
+
+def profile_summary(stats):
+    """ returns a table of the counters collected by `profiling` """
+    lines = ['%-45s %8s %12s %10s %12s %11s %11s %10s %10s'%('name', 'calls', 'elements', 'seconds', 'iterations', 'unconverged', 'residual', 'c_min', 'c_max')]
+    for name, counters in sorted(stats.items()):
+        lines.append('%-45s %8d %12d %10.3e %12d %11d %11.2e %10s %10s'%(name, counters['calls'], counters['elements'], counters['seconds'], counters['iterations'], counters['unconverged'], counters['residual'],
+                     '%.3g'%counters['c_min'] if 'c_min' in counters else '', '%.3g'%counters['c_max'] if 'c_max' in counters else ''))
+    return '\n'.join(lines)+'\n'
+
 def print_fit_params_and_pivots(table,is_lite=False):
     iparam=-1
     fit_parameter_names = __fit_parameter_names if not is_lite else __fit_parameter_lite_names
@@ -81,13 +152,14 @@ def set_fit_parameters(table, **kw):
             
 
 
-def fit_from_ragagnin2019_fit(table, pivots, use_lite_mc_fit=False, **kw):
+def ragagnin2019_coefficients(table, pivots, use_lite_mc_fit=False, dtype=None, **kw):
+    """ returns the cosmology dependent coefficients A, B, C of ln(X) = A + B ln(M/M_pivot) + C ln(a/a_pivot) """
     if not  use_lite_mc_fit:
         norm, slopem, slopea,   pim , pib, pis, pih,    sim, sib, sis, sih,       aim, aib, ais, aih, sigma = table
     else:
         norm, slopem, slopea,   pim , pib, pis, pih,     aim, aib, ais, aih, sigma = table
 
-    logM, loga, logomega_m, logomega_b, logsigma8, logh0 = [np.log(np.array(kw[pivot]) / pivots[pivot]) if pivot in pivots else 0. for pivot in __fit_pivot_names]
+    logomega_m, logomega_b, logsigma8, logh0 = [np.log(np.asarray(kw[pivot], dtype=dtype) / pivots[pivot]) if pivot in pivots else 0. for pivot in __fit_pivot_names[2:]]
 
 
 
@@ -101,19 +173,81 @@ def fit_from_ragagnin2019_fit(table, pivots, use_lite_mc_fit=False, **kw):
     
     slopea_2 = slopea + aim*   logomega_m +aib* logomega_b  + ais* logsigma8  + aih* logh0
 
-    return np.exp(norm_2 + logM*slopem_2 +  loga*slopea_2)
+    return norm_2, slopem_2, slopea_2
+
+def fit_from_ragagnin2019_fit(table, pivots, use_lite_mc_fit=False, out=None, scratch=None, dtype=None, **kw):
+    """ evaluates exp(A + B ln(M/M_pivot) + C ln(a/a_pivot)) in place in `out` (allocated if None), using `scratch` (allocated if needed)
+        for ln(a/a_pivot). Use dtype=np.float32 to compute in single precision. """
+    norm_2, slopem_2, slopea_2 = ragagnin2019_coefficients(table, pivots, use_lite_mc_fit=use_lite_mc_fit, dtype=dtype, **kw)
+    M, a = [np.asarray(kw[pivot], dtype=dtype) if pivot in pivots else None for pivot in __fit_pivot_names[:2]]
+    if out is None and all(np.ndim(x)==0 for x in (M, a, norm_2, slopem_2, slopea_2)):
+        return np.exp(norm_2 + (0. if M is None else np.log(M/pivots['M'])*slopem_2) + (0. if a is None else np.log(a/pivots['a'])*slopea_2))
+    if out is None:
+        shape = np.broadcast_shapes(*[np.shape(x) for x in (M, a, norm_2, slopem_2, slopea_2) if x is not None])
+        out = np.empty(shape, dtype=np.result_type(*[x for x in (M, a, norm_2, slopem_2, slopea_2) if x is not None]) if dtype is None else dtype)
+    if M is not None:
+        np.divide(M, pivots['M'], out=out)
+        np.log(out, out=out)
+        np.multiply(out, slopem_2, out=out)
+        np.add(out, norm_2, out=out)
+    else:
+        out[...] = norm_2
+    if a is not None:
+        if np.ndim(a)==0:
+            out += np.log(a/pivots['a'])*slopea_2
+        else:
+            if scratch is None:
+                scratch = np.empty_like(out)
+            np.divide(a, pivots['a'], out=scratch)
+            np.log(scratch, out=scratch)
+            np.multiply(scratch, slopea_2, out=scratch)
+            np.add(out, scratch, out=out)
+    np.exp(out, out=out)
+    return out[()] if out.ndim==0 else out
+
+def ragagnin2019_fit_gradient(table, pivots, use_lite_mc_fit=False, **kw):
+    """ returns the fit of `fit_from_ragagnin2019_fit` and a dict with its derivatives: keys M, a, omega_m, omega_b, sigma8 and h0
+        contain d ln(X)/d ln(x), while the keys of the fit parameters (A0, B0, ..., sigma) contain d ln(X)/d parameter """
+    value = fit_from_ragagnin2019_fit(table, pivots, use_lite_mc_fit=use_lite_mc_fit, **kw)
+    norm_2, slopem_2, slopea_2 = ragagnin2019_coefficients(table, pivots, use_lite_mc_fit=use_lite_mc_fit, **kw)
+    logs = dict((pivot, np.log(np.array(kw[pivot]) / pivots[pivot]) if pivot in pivots else 0.) for pivot in __fit_pivot_names)
+    logM, loga = logs['M'], logs['a']
+    cosmology = __fit_pivot_names[2:]
+    alpha = table[3:7]
+    beta = table[7:11] if not use_lite_mc_fit else [0.]*4
+    gamma = table[11:15] if not use_lite_mc_fit else table[7:11]
+    zero = np.zeros(np.shape(value))
+    gradient = {}
+    gradient['M'] = zero + (slopem_2 if 'M' in pivots else 0.)
+    gradient['a'] = zero + (slopea_2 if 'a' in pivots else 0.)
+    for x, alpha_x, beta_x, gamma_x in zip(cosmology, alpha, beta, gamma):
+        gradient[x] = zero + ((alpha_x + beta_x*logM + gamma_x*loga) if x in pivots else 0.)
+    fit_parameter_names = __fit_parameter_names if not use_lite_mc_fit else __fit_parameter_lite_names
+    derivatives = [1., logM, loga] + [logs[x] for x in cosmology]
+    if not use_lite_mc_fit:
+        derivatives += [logM*logs[x] for x in cosmology]
+    derivatives += [loga*logs[x] for x in cosmology] + [0.]
+    for name, derivative in zip(fit_parameter_names, derivatives):
+        gradient[name] = zero + derivative
+    return value, gradient
+
+def mc_fit_table(delta, use_lite_mc_fit=False, use_lite_mc_dm_fit=False):
+    if use_lite_mc_dm_fit and not  use_lite_mc_fit:
+        raise Exception('If you activate use_lite_mc_dm_fit= you must also activate use_lite_mc_fit=True')
+    if use_lite_mc_fit and use_lite_mc_dm_fit:
+        return __mc_dm_lite_fit_parameters[delta]
+    elif use_lite_mc_fit:
+        return  __mc_lite_fit_parameters[delta]
+    else:
+        return  __mc_fit_parameters[delta]
 
-def concentration_from_mc_relation(delta, M, a, omega_m, omega_b, sigma8, h0, use_lite_mc_fit=False, use_lite_mc_dm_fit=False, show_fit_parameters=False, table=None, **kw):
+@profiled('delta')
+def concentration_from_mc_relation(delta, M, a, omega_m, omega_b, sigma8, h0, use_lite_mc_fit=False, use_lite_mc_dm_fit=False, show_fit_parameters=False, table=None, gradient=False, **kw):
 
     if use_lite_mc_dm_fit and not  use_lite_mc_fit:
         raise Exception('If you activate use_lite_mc_dm_fit= you must also activate use_lite_mc_fit=True')
     if table is None:
-        if use_lite_mc_fit and use_lite_mc_dm_fit:
-            table = __mc_dm_lite_fit_parameters[delta]
-        elif use_lite_mc_fit:
-            table =  __mc_lite_fit_parameters[delta]
-        else:
-            table =  __mc_fit_parameters[delta]
+        table = mc_fit_table(delta, use_lite_mc_fit=use_lite_mc_fit, use_lite_mc_dm_fit=use_lite_mc_dm_fit)
     if show_fit_parameters:
         print(' MC relation fit: ')
         print('     ln(c_delta) = A + B ln(M_delta/Mp) + C ln(a/ap) ')
@@ -123,17 +257,26 @@ def concentration_from_mc_relation(delta, M, a, omega_m, omega_b, sigma8, h0, us
         print('    Delta = %s'% delta)
         print_fit_params_and_pivots(table,is_lite= use_lite_mc_fit)
 
+    if gradient:
+        return ragagnin2019_fit_gradient( table['params'], table['pivots'],use_lite_mc_fit=use_lite_mc_fit,
+                                         M=M,a=a,omega_m=omega_m, omega_b=omega_b, sigma8=sigma8, h0=h0,
+                                         **kw)
     return fit_from_ragagnin2019_fit( table['params'], table['pivots'],use_lite_mc_fit=use_lite_mc_fit,
                                          M=M,a=a,omega_m=omega_m, omega_b=omega_b, sigma8=sigma8, h0=h0,
                                          **kw)
 
 
 
-def mass_from_mm_relation(delta_from, delta_to, M, a, omega_m, omega_b, sigma8, h0,  show_fit_parameters=False,  table=None, **kw):
+@profiled('delta_from', 'delta_to')
+def mass_from_mm_relation(delta_from, delta_to, M, a, omega_m, omega_b, sigma8, h0,  show_fit_parameters=False,  table=None, gradient=False, **kw):
     if show_fit_parameters:
                     print_fit_params_and_pivots(__mm_fit_parameters[delta_from][delta_to])
     if table is None:
         table = __mm_fit_parameters[delta_from][delta_to]
+    if gradient:
+        return ragagnin2019_fit_gradient( table['params'], table['pivots'],
+                                         M=M,a=a,omega_m=omega_m, omega_b=omega_b, sigma8=sigma8, h0=h0,
+                                         **kw)
     return fit_from_ragagnin2019_fit( table['params'], table['pivots'],
                                          M=M,a=a,omega_m=omega_m, omega_b=omega_b, sigma8=sigma8, h0=h0,
                                          **kw)
@@ -151,8 +294,24 @@ def delta_c(a, Omega_M, Omegar, Omegak, Omegal):
 def f_NFW(c):
     return (np.log(1.+c)-c/(1.+c))
 
+def critical_overdensity_gradient(delta, **args):
+    """ returns the overdensity of `critical_overdensity` and its derivatives d ln(delta)/d ln(a) and d ln(delta)/d ln(omega_m) """
+    overdensity = critical_overdensity(delta, **args)
+    if 'c' in delta and delta!='vir':
+        return overdensity, 0., 0.
+    a, omega_m = args['a'], args['omega_m']
+    Omegaz = Omega(a, omega_m, 0., 0., 1.- omega_m)
+    dlnOmega_dlna = -3.*(1.-Omegaz)
+    dlnOmega_dlnomega_m = 1. - omega_m*(a**-3.-1.)/(omega_m * a**-3. + 1.- omega_m)
+    if delta=='vir':
+        dlnoverdensity_dlnOmega = (82. - 78.*(Omegaz-1.))*Omegaz/overdensity
+    else:
+        dlnoverdensity_dlnOmega = 1.
+    return overdensity, dlnoverdensity_dlnOmega*dlnOmega_dlna, dlnoverdensity_dlnOmega*dlnOmega_dlnomega_m
+
 def banach_caccioppoli(f,x0,accuracy=0.001):
     """ this function solves equation of the kind x=f(x) by iterations, given an initial value x=x0"""
+    start = __profile and time.perf_counter()
     condition=True
     x1=x0
     steps=0
@@ -163,6 +322,8 @@ def banach_caccioppoli(f,x0,accuracy=0.001):
         error = np.abs(x2-x1)/x2
         condition = np.all(error>accuracy)
         x1=x2
+    __profile and profile_record('solver banach_caccioppoli', time.perf_counter()-start, elements=np.size(x2), iterations=steps,
+                                 unconverged=np.sum(error>accuracy), residual=np.max(error), c=x2)
     return x2
 
 def critical_overdensity(delta,  **args):
@@ -172,6 +333,10 @@ def critical_overdensity(delta,  **args):
         return delta_c(args['a'], args['omega_m'], 0., 0., 1.- args['omega_m'])
     elif  'c' in delta:
         return float(delta[:-1])
+    elif delta.endswith('m'):
+        if('a' not in args or args['a'] is None or 'omega_m' not in args or args['omega_m'] is None):
+            raise Exception("You need to provide parameters a and omega_m if you use a delta==%s"%delta)
+        return float(delta[:-1]) * Omega(args['a'], args['omega_m'], 0., 0., 1.- args['omega_m'])
     else:
         raise Exception("Critical overdensity cannot be obtained from %s",delta)
 
@@ -180,9 +345,246 @@ def cdelta1(delta2,delta1,cdelta1, f_NFW=f_NFW):
      return lambda cdelta2: cdelta1 * (  (delta1/delta2)*(f_NFW(cdelta2)/f_NFW(cdelta1))  )**(1./3.)
 
 
-def c2_bc(delta2, delta1, c1, f_NFW=f_NFW):
-    c2 = banach_caccioppoli( cdelta1(delta2, delta1, c1, f_NFW = f_NFW), c1)
-    return c2
+def df_NFW(c):
+    return c/(1.+c)**2.
+
+# number of elements solved at once by the NFW solvers
+__block_size = 2**15
+
+def newton_block(x, lo, hi, residual, parameters, accuracy, max_iterations):
+    """ safeguarded Newton iterations on the elements x, with bracket [lo, hi], where residual(x, *parameters) returns a residual that increases with x
+        and its derivative. Steps that leave the bracket fall back to bisection, and elements whose step is below `accuracy` are removed from
+        the active set together with their `parameters`. Returns the solution, the number of iterations and the number of elements that did not converge """
+    result = x.copy()
+    active = np.arange(x.size)
+    iterations = 0
+    for i in range(max_iterations):
+        if active.size==0:
+            break
+        iterations += 1
+        g, dg = residual(x, *parameters)
+        lo = np.where(g<0., x, lo)
+        hi = np.where(g>0., x, hi)
+        x_new = x - g/dg
+        # the step of an element at the root can round to zero, so the bracket is inclusive
+        outside = ~((x_new>=lo) & (x_new<=hi))
+        x_new = np.where(outside, 0.5*(lo+hi), x_new)
+        converged = np.abs(x_new-x) < accuracy
+        x = x_new
+        if np.any(converged):
+            result[active[converged]] = x[converged]
+            keep = ~converged
+            active, x, lo, hi = active[keep], x[keep], lo[keep], hi[keep]
+            parameters = tuple(parameter[keep] for parameter in parameters)
+    result[active] = x
+    return result, iterations, active.size
+
+def newton_blocks(n, solve_block):
+    """ calls solve_block(block) on slices of `__block_size` of n elements, so that the memory used does not grow with n;
+        solve_block returns its number of iterations, of unconverged elements and its maximum residual, which are combined over all blocks """
+    iterations, failures, residual = 0, 0, 0.
+    for block in range(0, n, __block_size):
+        block_iterations, block_failures, block_residual = solve_block(slice(block, block+__block_size))
+        iterations, failures, residual = max(iterations, block_iterations), failures + block_failures, max(residual, block_residual)
+    return iterations, failures, residual
+
+def c2_newton(delta2, delta1, c1, f_NFW=f_NFW, df_NFW=None, accuracy=None, max_iterations=None, out=None, dtype=None):
+    """ this function solves (c2/c1)^3 = delta1/delta2 * f(c2)/f(c1) for c2 with a safeguarded Newton method on u=ln(c2).
+        Every element is iterated until its own step is below `accuracy` (relative on c2) and is then removed from the active set,
+        so that already converged elements are not evaluated again. Steps that leave the bracket of the root fall back to bisection.
+        If `df_NFW` is None and f_NFW is not the NFW profile, the derivative is computed with finite differences.
+        Elements are solved in blocks of `__block_size`, so that besides the result (written in `out`, if provided) the memory used does not grow with the input size.
+        With dtype=np.float32 the default accuracy is 10 times the float32 resolution."""
+    start = __profile and time.perf_counter()
+    dtype = np.dtype(float if dtype is None else dtype)
+    if accuracy is None:
+        accuracy = max(1e-8, 10.*np.finfo(dtype).eps)
+    if max_iterations is None:
+        max_iterations = 100
+    if df_NFW is None and f_NFW is globals()['f_NFW']:
+        df_NFW = globals()['df_NFW']
+    c1, delta2, delta1 = np.broadcast_arrays(np.asarray(c1), np.asarray(delta2), np.asarray(delta1))
+    shape = c1.shape
+    c1, delta2, delta1 = c1.reshape(-1), delta2.reshape(-1), delta1.reshape(-1)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    contiguous = out.flags['C_CONTIGUOUS']
+    result = out.reshape(-1) if contiguous else np.empty(c1.size, dtype=out.dtype)
+    def G(u, target):
+        return 3.*u - np.log(f_NFW(np.exp(u))) - target
+    def residual(u, target):
+        c = np.exp(u)
+        f = f_NFW(c)
+        if df_NFW is not None:
+            return 3.*u - np.log(f) - target, 3. - c*df_NFW(c)/f
+        h = 1e-6
+        return G(u, target), (G(u+h, target) - G(u-h, target))/(2.*h)
+    #elements are solved in blocks that fit in the CPU cache
+    def solve_block(block):
+        log_ratio = np.log(np.asarray(delta2[block], dtype=dtype)/np.asarray(delta1[block], dtype=dtype))
+        u = np.log(np.asarray(c1[block], dtype=dtype))
+        # the root satisfies G(u) = 3u - ln f(e^u) - 3ln(c1) + ln f(c1) + ln(delta2/delta1) = 0, with G(ln c1) = ln(delta2/delta1)
+        target = 3.*u - np.log(f_NFW(np.exp(u))) - log_ratio
+        # for NFW 1 <= G' <= 3, so the root lies within [u0 - G0, u0 - G0/3]; other profiles get their bracket expanded below
+        lo = np.where(log_ratio>0., u - log_ratio, u - log_ratio/3.)
+        hi = np.where(log_ratio>0., u - log_ratio/3., u - log_ratio)
+        if df_NFW is not globals()['df_NFW']:
+            width = np.abs(log_ratio)+1.
+            for i in range(max_iterations):
+                bad = (G(lo, target)>0.) | (G(hi, target)<0.)
+                if not np.any(bad):
+                    break
+                lo = np.where(bad, lo - width, lo)
+                hi = np.where(bad, hi + width, hi)
+                width = width*2.
+        active = np.flatnonzero(log_ratio!=0.)
+        u[active], iterations, failures = newton_block(u[active], lo[active], hi[active], residual, (target[active],), accuracy, max_iterations)
+        np.exp(u, out=result[block])
+        return iterations, failures, np.max(np.abs(G(u, target)), initial=0.) if __profile else 0.
+    iterations, failures, max_residual = newton_blocks(c1.size, solve_block)
+    if not contiguous:
+        out[...] = result.reshape(shape)
+    __profile and profile_record('solver newton', time.perf_counter()-start, elements=c1.size, iterations=iterations, unconverged=failures,
+                                 residual=max_residual, c=out)
+    return out[()] if out.ndim==0 else out
+
+__nfw_tables = {}
+
+def cubic_weights(t):
+    """ weights of the 4-point Lagrange interpolation on nodes -1, 0, 1, 2 for 0 <= t < 1 """
+    return [-t*(t-1.)*(t-2.)/6., (t+1.)*(t-1.)*(t-2.)/2., -(t+1.)*t*(t-2.)/2., (t+1.)*t*(t-1.)/6.]
+
+def interpolate_nfw_table(nfw_table, log_ratio, log_c):
+    """ bicubic interpolation of ln(c2/c1) on the points (ln(delta2/delta1), ln(c1)), points must be inside the table ranges """
+    values = nfw_table['values']
+    nx, ny = values.shape
+    values = np.asarray(values).ravel()
+    (x0, y0), (dx, dy) = nfw_table['start'], nfw_table['step']
+    tx = (log_ratio - x0)/dx
+    ty = (log_c - y0)/dy
+    ix = np.clip(tx.astype(int), 1, nx-3)
+    iy = np.clip(ty.astype(int), 1, ny-3)
+    wx = cubic_weights(tx-ix)
+    wy = cubic_weights(ty-iy)
+    #flat index of the node (-1,-1) of the stencil
+    corner = (ix-1)*ny + iy-1
+    result = np.zeros(np.shape(log_ratio))
+    for i in range(4):
+        row = wy[0]*values[corner]
+        for j in range(1,4):
+            row += wy[j]*values[corner+j]
+        result += wx[i]*row
+        corner += ny
+    return result
+
+def nfw_table(log_ratio_range=(-5., 5.), c_range=(0.1, 100.), step=0.05, tolerance=1e-6, cache_dir=None):
+    """ returns a table of ln(c2/c1) for the NFW profile on a regular grid in ln(delta2/delta1) and ln(c1).
+        The grid is refined until the bicubic interpolation has a maximum relative error on c2 below `tolerance` (checked on the centre of each cell).
+        Tables are kept in memory and saved in `cache_dir` (default: $HYDRO_MC_CACHE or ~/.cache/hydro_mc), and later loaded as memory-mapped files."""
+    key = (tuple(log_ratio_range), tuple(c_range), step, tolerance)
+    if key in __nfw_tables:
+        return __nfw_tables[key]
+    if cache_dir is None:
+        cache_dir = os.environ.get('HYDRO_MC_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'hydro_mc'))
+    path = os.path.join(cache_dir, 'nfw_table_%g_%g_%g_%g_%g_%g.npy'%(log_ratio_range[0], log_ratio_range[1], c_range[0], c_range[1], step, tolerance))
+    x_range = np.array(log_ratio_range, dtype=float)
+    y_range = np.log(np.array(c_range, dtype=float))
+    def grid(x_range, n):
+        #one extra node on each side, so that the whole range is covered by the 4-point stencil
+        dx = (x_range[1]-x_range[0])/(n-3)
+        return x_range[0]-dx + dx*np.arange(n), dx
+    if os.path.exists(path):
+        values = np.load(path, mmap_mode='r')
+        max_relative_error = tolerance
+    else:
+        nx = int(np.ceil((x_range[1]-x_range[0])/step))+3
+        ny = int(np.ceil((y_range[1]-y_range[0])/step))+3
+        for refinement in range(8):
+            x, dx = grid(x_range, nx)
+            y, dy = grid(y_range, ny)
+            X, Y = np.meshgrid(x, y, indexing='ij')
+            values = np.log(c2_newton(np.exp(X), 1., np.exp(Y), accuracy=1e-13)) - Y
+            table = {'values': values, 'start': (x[0], y[0]), 'step': (dx, dy)}
+            X, Y = np.meshgrid(x[1:-2]+0.5*dx, y[1:-2]+0.5*dy, indexing='ij')
+            exact = np.log(c2_newton(np.exp(X), 1., np.exp(Y), accuracy=1e-13)) - Y
+            max_relative_error = np.max(np.abs(np.expm1(interpolate_nfw_table(table, X, Y) - exact)))
+            if max_relative_error <= tolerance:
+                break
+            nx, ny = 2*nx-3, 2*ny-3
+        else:
+            raise Exception('Unable to build an NFW table with tolerance %g, the maximum relative error is %g'%(tolerance, max_relative_error))
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = '%s.%d.tmp'%(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, values)
+            os.replace(tmp_path, path)
+            values = np.load(path, mmap_mode='r')
+        except OSError:
+            pass
+    x, dx = grid(x_range, values.shape[0])
+    y, dy = grid(y_range, values.shape[1])
+    table = {'values': values, 'start': (x[0], y[0]), 'step': (dx, dy), 'log_ratio_range': tuple(x_range), 'log_c_range': tuple(y_range),
+             'tolerance': tolerance, 'max_relative_error': max_relative_error}
+    __nfw_tables[key] = table
+    return table
+
+def c2_table(delta2, delta1, c1, nfw_table=None, accuracy=None, max_iterations=None, out=None, dtype=None):
+    """ same as c2_newton for the NFW profile, but interpolates a precomputed table (see `nfw_table`).
+        Elements outside the table ranges are solved with `c2_newton`."""
+    start = __profile and time.perf_counter()
+    if nfw_table is None:
+        nfw_table = globals()['nfw_table']()
+    dtype = np.dtype(float if dtype is None else dtype)
+    c1, delta2, delta1 = np.broadcast_arrays(np.asarray(c1), np.asarray(delta2), np.asarray(delta1))
+    shape = c1.shape
+    c1, delta2, delta1 = c1.reshape(-1), delta2.reshape(-1), delta1.reshape(-1)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    contiguous = out.flags['C_CONTIGUOUS']
+    result = out.reshape(-1) if contiguous else np.empty(c1.size, dtype=out.dtype)
+    (x_min, x_max), (y_min, y_max) = nfw_table['log_ratio_range'], nfw_table['log_c_range']
+    for block in range(0, c1.size, __block_size):
+        block = slice(block, block+__block_size)
+        block_c1 = np.asarray(c1[block], dtype=float)
+        log_ratio = np.log(np.asarray(delta2[block], dtype=float)/np.asarray(delta1[block], dtype=float))
+        log_c = np.log(block_c1)
+        inside = (log_ratio>=x_min) & (log_ratio<=x_max) & (log_c>=y_min) & (log_c<=y_max)
+        if np.all(inside):
+            result[block] = block_c1*np.exp(interpolate_nfw_table(nfw_table, log_ratio, log_c))
+        else:
+            c2 = np.empty_like(block_c1)
+            c2[inside] = block_c1[inside]*np.exp(interpolate_nfw_table(nfw_table, log_ratio[inside], log_c[inside]))
+            c2[~inside] = c2_newton(np.exp(log_ratio[~inside]), 1., block_c1[~inside], accuracy=accuracy, max_iterations=max_iterations)
+            result[block] = c2
+    if not contiguous:
+        out[...] = result.reshape(shape)
+    __profile and profile_record('solver table', time.perf_counter()-start, elements=c1.size, residual=nfw_table['max_relative_error'], c=out)
+    return out[()] if out.ndim==0 else out
+
+def c2_bc(delta2, delta1, c1, f_NFW=f_NFW, solver='banach_caccioppoli', accuracy=None, max_iterations=None, out=None, dtype=None):
+    """ converts concentration c1 in overdensity delta1 to the concentration in delta2.
+        Use solver='banach_caccioppoli' for the fixed point iteration, solver='newton' for the per-element array solver `c2_newton`
+        and solver='table' for the interpolation of a precomputed NFW table `c2_table`.
+        The result is written in `out`, if provided, and computed in `dtype` (e.g. np.float32), if provided. Only the newton and table
+        solvers work in blocks without allocating arrays as large as the input."""
+    if solver=='newton':
+        return c2_newton(delta2, delta1, c1, f_NFW=f_NFW, accuracy=accuracy, max_iterations=max_iterations, out=out, dtype=dtype)
+    elif solver=='table':
+        if f_NFW is not globals()['f_NFW']:
+            raise Exception('solver="table" is available only for the NFW profile')
+        return c2_table(delta2, delta1, c1, accuracy=accuracy, max_iterations=max_iterations, out=out, dtype=dtype)
+    elif solver=='banach_caccioppoli':
+        if dtype is not None:
+            c1, delta2, delta1 = [np.asarray(x, dtype=dtype) for x in (c1, delta2, delta1)]
+        c2 = banach_caccioppoli( cdelta1(delta2, delta1, c1, f_NFW = f_NFW), c1, **({} if accuracy is None else {'accuracy':accuracy}))
+        if out is not None:
+            out[...] = c2
+            return out[()] if out.ndim==0 else out
+        return c2
+    else:
+        raise Exception('Unknown solver "%s", use "banach_caccioppoli", "newton" or "table"'%solver)
 
 
 def  HK_func(x):
@@ -202,31 +604,638 @@ def HK_1(delta, delta_vir, cvir):
     return 1./x1
     
 
-def convert_concentration(delta_from, delta_to, concentration, f_profile=None,  c_hu_kratsov_2002=False, **kw):
+def nfw_log_slope(c):
+    """ d ln f_NFW / d ln c """
+    return c*df_NFW(c)/f_NFW(c)
+
+def convert_concentration_gradient(delta_from, delta_to, concentration, new_c, **kw):
+    """ derivatives of the NFW conversion of `concentration` (in delta_from) to `new_c` (in delta_to) from the implicit function theorem:
+        returns d ln(new_c)/d ln(c), d ln(new_c)/d ln(a) and d ln(new_c)/d ln(omega_m) """
+    overdensity_from, dlnfrom_dlna, dlnfrom_dlnomega_m = critical_overdensity_gradient(delta_from, **kw)
+    overdensity_to, dlnto_dlna, dlnto_dlnomega_m = critical_overdensity_gradient(delta_to, **kw)
+    # 3 ln(new_c) - ln f(new_c) = ln(delta_from/delta_to) + 3 ln(c) - ln f(c)
+    slope_from = 3. - nfw_log_slope(concentration)
+    slope_to = 3. - nfw_log_slope(new_c)
+    return slope_from/slope_to, -(dlnto_dlna - dlnfrom_dlna)/slope_to, -(dlnto_dlnomega_m - dlnfrom_dlnomega_m)/slope_to
+
+@profiled('delta_from', 'delta_to')
+def convert_concentration(delta_from, delta_to, concentration, f_profile=None,  c_hu_kratsov_2002=False, solver='banach_caccioppoli', gradient=False, **kw):
     overdensity_from = critical_overdensity(delta_from, **kw)
     overdensity_to = critical_overdensity(delta_to, **kw)
+    if gradient:
+        if c_hu_kratsov_2002 or (f_profile is not None and f_profile is not f_NFW):
+            raise Exception('gradient=True is available only for the NFW conversion')
+        new_c = c2_bc(overdensity_to, overdensity_from, concentration, solver=solver, accuracy=kw.get('accuracy'), max_iterations=kw.get('max_iterations'))
+        dlnc_dlnc, dlnc_dlna, dlnc_dlnomega_m = convert_concentration_gradient(delta_from, delta_to, concentration, new_c, **kw)
+        return new_c, {'c': dlnc_dlnc, 'a': dlnc_dlna, 'omega_m': dlnc_dlnomega_m}
     if not  c_hu_kratsov_2002:
         if f_profile is None:
             f_profile = f_NFW
-        return c2_bc(overdensity_to, overdensity_from, concentration, f_NFW=f_profile)
+        return c2_bc(overdensity_to, overdensity_from, concentration, f_NFW=f_profile, solver=solver, accuracy=kw.get('accuracy'), max_iterations=kw.get('max_iterations'),
+                     out=kw.get('out'), dtype=kw.get('dtype'))
     else:
-        return HK_1(overdensity_to, overdensity_from, concentration)
-
-def mass_from_m_and_c(delta_from, delta_to, concentration,  **kw):
+        new_c = HK_1(overdensity_to, overdensity_from, concentration)
+        if kw.get('out') is not None:
+            kw['out'][...] = new_c
+            return kw['out']
+        return new_c
+
+def overlaps(buffers, inputs):
+    """ True if one of the output `buffers` shares memory with one of the array `inputs` """
+    return any(isinstance(buffer, np.ndarray) and isinstance(x, np.ndarray) and np.shares_memory(buffer, x) for buffer in buffers for x in inputs)
+
+@profiled('delta_from', 'delta_to')
+def mass_from_m_and_c(delta_from, delta_to, concentration,  solver='banach_caccioppoli', out=None, dtype=None, **kw):
     c = concentration
-    overdensity_from = critical_overdensity(delta_from, a=a, omega_m = omega_m, **kw)
-    overdensity_to = critical_overdensity(delta_to,  a=a, omega_m = omega_m, **kw)
-    new_c =  c2_bc(overdensity_to, overdensity_from, c)
-    return    kw['M'] * (overdensity_to/overdensity_from)*(new_c/c)**3.
-
-
-def mass_from_mc_relation(delta_from, delta_to, M, a, omega_m, omega_b, sigma8, h0,   **kw):
+    # `out` is written before M and c are read for the last time, so an `out` that aliases them is only filled at the end
+    target = None
+    if overlaps([out], [c, kw.get('M')]):
+        target, out = out, None
+    overdensity_from = critical_overdensity(delta_from, **kw)
+    overdensity_to = critical_overdensity(delta_to, **kw)
+    new_c =  c2_bc(overdensity_to, overdensity_from, c, solver=solver, accuracy=kw.get('accuracy'), max_iterations=kw.get('max_iterations'), out=out, dtype=dtype)
+    new_M = mass_from_c_ratio(kw['M'], overdensity_to, overdensity_from, new_c, c)
+    if target is None:
+        return new_M
+    target[...] = new_M
+    return target
+
+def mass_from_c_ratio(M, overdensity_to, overdensity_from, new_c, c):
+    """ M * (overdensity_to/overdensity_from) * (new_c/c)^3, computed in place in the array `new_c` """
+    if np.ndim(new_c)==0 or np.shape(new_c)!=np.broadcast_shapes(*[np.shape(x) for x in (M, overdensity_to, overdensity_from, new_c, c)]):
+        return    M * (overdensity_to/overdensity_from)*(new_c/c)**3.
+    np.divide(new_c, c, out=new_c)
+    np.power(new_c, 3., out=new_c)
+    for factor in (M, overdensity_to):
+        np.multiply(new_c, factor, out=new_c)
+    np.divide(new_c, overdensity_from, out=new_c)
+    return new_c
+
+
+@profiled('delta_from', 'delta_to')
+def mass_from_mc_relation(delta_from, delta_to, M, a, omega_m, omega_b, sigma8, h0,  solver='banach_caccioppoli', gradient=False, out=None, scratch=None, dtype=None, **kw):
+    # `out` and `scratch` are written before the inputs are read for the last time, so buffers that alias them are only filled at the end
+    target = None
+    if overlaps([out, scratch], [M, a, omega_m, omega_b, sigma8, h0]):
+        target, out, scratch = out, None, None
     overdensity_from = critical_overdensity(delta_from,  a=a, omega_m = omega_m,**kw)
     overdensity_to = critical_overdensity(delta_to,  a=a, omega_m = omega_m, **kw)
-    c =  concentration_from_mc_relation(delta_from, M, a, omega_m, omega_b, sigma8, h0, **kw)
-    new_c =  c2_bc(overdensity_to, overdensity_from, c)
-    M = M* (overdensity_to/overdensity_from)*(new_c/c)**3.
-    return   M
+    if gradient:
+        c, c_gradient = concentration_from_mc_relation(delta_from, M, a, omega_m, omega_b, sigma8, h0, gradient=True, dtype=dtype, **kw)
+    else:
+        # the concentration goes in `scratch`, while `out` is the scratch of the MC relation until the solve
+        c =  concentration_from_mc_relation(delta_from, M, a, omega_m, omega_b, sigma8, h0, out=scratch, scratch=out, dtype=dtype, **kw)
+    new_c =  c2_bc(overdensity_to, overdensity_from, c, solver=solver, accuracy=kw.get('accuracy'), max_iterations=kw.get('max_iterations'), out=out, dtype=dtype)
+    if not gradient:
+        new_M = mass_from_c_ratio(M, overdensity_to, overdensity_from, new_c, c)
+    else:
+        new_M = M* (overdensity_to/overdensity_from)*(new_c/c)**3.
+    if target is not None:
+        target[...] = new_M
+        new_M = target
+    if not gradient:
+        return new_M
+    # ln(new_M) = ln(M) + ln(delta_to/delta_from) + 3 ln(new_c) - 3 ln(c)
+    dlnc_dlnc, dlnc_dlna, dlnc_dlnomega_m = convert_concentration_gradient(delta_from, delta_to, c, new_c, a=a, omega_m=omega_m)
+    dlnoverdensity_dlna = critical_overdensity_gradient(delta_to, a=a, omega_m=omega_m)[1] - critical_overdensity_gradient(delta_from, a=a, omega_m=omega_m)[1]
+    dlnoverdensity_dlnomega_m = critical_overdensity_gradient(delta_to, a=a, omega_m=omega_m)[2] - critical_overdensity_gradient(delta_from, a=a, omega_m=omega_m)[2]
+    M_gradient = dict((name, 3.*(dlnc_dlnc-1.)*derivative) for name, derivative in c_gradient.items())
+    M_gradient['M'] = M_gradient['M'] + 1.
+    M_gradient['a'] = M_gradient['a'] + dlnoverdensity_dlna + 3.*dlnc_dlna
+    M_gradient['omega_m'] = M_gradient['omega_m'] + dlnoverdensity_dlnomega_m + 3.*dlnc_dlnomega_m
+    return new_M, M_gradient
+
+@profiled('delta_from', 'delta_to')
+def inverse_mass_from_mm_relation(delta_from, delta_to, M, a, omega_m, omega_b, sigma8, h0, table=None, **kw):
+    """ returns the mass in `delta_from` whose `mass_from_mm_relation` in `delta_to` is M, from the inverse of ln(M) = A + B ln(M_from/M_pivot) + C ln(a/a_pivot) """
+    if table is None:
+        table = __mm_fit_parameters[delta_from][delta_to]
+    pivots = table['pivots']
+    A, B, C = ragagnin2019_coefficients(table['params'], pivots, omega_m=omega_m, omega_b=omega_b, sigma8=sigma8, h0=h0)
+    loga = np.log(np.asarray(a)/pivots['a']) if 'a' in pivots else 0.
+    return pivots['M']*np.exp((np.log(M) - A - C*loga)/B)
+
+def inverse_mc_residual(x, y, d, L0, B):
+    """ residual of `inverse_mass_from_mc_relation` in x = ln(M_from), ln(f(c2)/f(c1)) - ln(M/M_from), and its derivative """
+    c1 = np.exp(L0 + B*x)
+    c2 = np.exp((y - x - d)/3. + L0 + B*x)
+    f1, f2 = f_NFW(c1), f_NFW(c2)
+    return np.log(f2) - np.log(f1) - y + x, 1. + c2*df_NFW(c2)/f2*(B - 1./3.) - c1*df_NFW(c1)/f1*B
+
+@profiled('delta_from', 'delta_to')
+def inverse_mass_from_mc_relation(delta_from, delta_to, M, a, omega_m, omega_b, sigma8, h0, use_lite_mc_fit=False, use_lite_mc_dm_fit=False, table=None,
+                                  accuracy=None, max_iterations=None, **kw):
+    """ returns the mass in `delta_from` whose `mass_from_mc_relation` in `delta_to` is M.
+        With c1 = c(M_from) from the MC relation and c2 = c1*(M/M_from * delta_from/delta_to)^(1/3), the NFW equation reads M/M_from = f(c2)/f(c1),
+        which is solved for ln(M_from) with the safeguarded Newton method of `c2_newton`, in blocks and removing converged haloes from the active set.
+        For NFW the root lies between ln(M) and ln(M) + 2 ln(delta_to/delta_from). Iterations stop when the step is below `accuracy`
+        (default 1e-10) relative on M_from, or after `max_iterations` (default 100). """
+    start = __profile and time.perf_counter()
+    if accuracy is None:
+        accuracy = 1e-10
+    if max_iterations is None:
+        max_iterations = 100
+    if use_lite_mc_dm_fit and not  use_lite_mc_fit:
+        raise Exception('If you activate use_lite_mc_dm_fit= you must also activate use_lite_mc_fit=True')
+    if table is None:
+        table = mc_fit_table(delta_from, use_lite_mc_fit=use_lite_mc_fit, use_lite_mc_dm_fit=use_lite_mc_dm_fit)
+    pivots = table['pivots']
+    A, B, C = ragagnin2019_coefficients(table['params'], pivots, use_lite_mc_fit=use_lite_mc_fit, omega_m=omega_m, omega_b=omega_b, sigma8=sigma8, h0=h0)
+    # ln(c1) = L0 + B ln(M_from)
+    L0 = A - (B*np.log(pivots['M']) if 'M' in pivots else 0.) + (C*np.log(np.asarray(a)/pivots['a']) if 'a' in pivots else 0.)
+    B = B if 'M' in pivots else 0.
+    d = np.log(critical_overdensity(delta_to, a=a, omega_m=omega_m)/critical_overdensity(delta_from, a=a, omega_m=omega_m))
+    y, d, L0, B = [x.reshape(-1) for x in np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (np.log(M), d, L0, B)])]
+    shape = np.broadcast_shapes(np.shape(M), np.shape(a), np.shape(omega_m), np.shape(omega_b), np.shape(sigma8), np.shape(h0))
+    x = np.empty(y.size)
+    def solve_block(block):
+        lo = np.minimum(y[block], y[block] + 2.*d[block]) - 1e-6
+        hi = np.maximum(y[block], y[block] + 2.*d[block]) + 1e-6
+        x[block], iterations, failures = newton_block(0.5*(lo+hi), lo, hi, inverse_mc_residual, (y[block], d[block], L0[block], B[block]), accuracy, max_iterations)
+        return iterations, failures, 0.
+    iterations, failures, residual = newton_blocks(y.size, solve_block)
+    M_from = np.exp(x).reshape(shape)
+    __profile and profile_record('solver inverse_mc', time.perf_counter()-start, elements=x.size, iterations=iterations, unconverged=failures)
+    return M_from[()] if M_from.ndim==0 else M_from
+
+# critical density of the Universe in Msun/kpc^3 for h0=1, from G = 6.67408e-11 m^3/kg/s^2 and Msun = 1.989e30 kg (as in mass-calibration.ipynb)
+__kpc_in_m = 3.0856775814913673e19
+rho_crit_h2_Msun_kpc3 = 3.*(100.e3/(1e3*__kpc_in_m))**2/(8.*np.pi*6.67408e-11) * __kpc_in_m**3/1.989e30
+
+def radius_from_mass(delta, M, a=None, omega_m=None, h0=None):
+    """ radius in kpc that encloses the mass M (in Msun) with overdensity `delta` with respect to the critical density of h0 """
+    overdensity = critical_overdensity(delta, a=a, omega_m=omega_m)
+    return (M/(overdensity*4./3.*np.pi*rho_crit_h2_Msun_kpc3*h0*h0))**(1./3.)
+
+def projected_nfw_from_rho0_rs(rho0, rs, radii):
+    """ projected density (Msun/kpc^2 if rho0 is in Msun/kpc^3 and rs in kpc) at the projected `radii` of an NFW profile with parameters rho0 and rs,
+        see Lokas & Mamon 2001. All parameters are broadcast against each other. """
+    x = np.asarray(radii, dtype=float)/rs
+    x2_1 = x*x-1.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        F = np.where(x>1., np.arccos(1./np.maximum(x, 1.))/np.sqrt(np.abs(x2_1)), np.arccosh(1./np.minimum(x, 1.))/np.sqrt(np.abs(x2_1)))
+        g = np.where(np.abs(x2_1)>1e-6, (1.-F)/x2_1, 1./3.)
+    return 2.*rho0*rs*g
+
+def projected_nfw_from_M_c(M, c, delta, a, omega_m, h0, radii):
+    """ projected density at `radii` (kpc) of an NFW profile with mass M (Msun) and concentration c in the overdensity `delta` """
+    rs = radius_from_mass(delta, M, a=a, omega_m=omega_m, h0=h0)/c
+    rho0 = M/(4.*np.pi*rs**3.*f_NFW(c))
+    return projected_nfw_from_rho0_rs(rho0, rs, radii)
+
+def projected_nfw_from_mc_relation(M, a, delta, omega_m, omega_b, sigma8, h0, radii, **kw):
+    """ same as `projected_nfw_from_M_c`, with the concentration taken from `concentration_from_mc_relation` """
+    c = concentration_from_mc_relation(delta, M, a, omega_m, omega_b, sigma8, h0, **kw)
+    return projected_nfw_from_M_c(M, c, delta, a, omega_m, h0, radii)
+
+def noisy_projected_nfw_profiles(M, c, delta, a, omega_m, h0, radii, sn, random_state=None):
+    """ returns (profiles, log_errors) of len(M) x len(radii) projected NFW profiles with lognormal noise of signal to noise `sn`,
+        where `log_errors` are the errors on ln(profiles) expected by `calibrate_masses` """
+    M, c, a, omega_m, h0 = [np.atleast_1d(np.asarray(x, dtype=float))[:,None] for x in (M, c, a, omega_m, h0)]
+    ideal = projected_nfw_from_M_c(M, c, delta, a, omega_m, h0, radii)
+    random_state = np.random.default_rng(random_state)
+    profiles = ideal*np.exp(random_state.normal(loc=0., scale=1./sn, size=ideal.shape))
+    return profiles, np.broadcast_to(1./np.asarray(sn, dtype=float), profiles.shape)
+
+def calibrate_masses(radii, rho, log_rho_err, delta, a, omega_m, omega_b, sigma8, h0, M_range=(1e12, 1e16), accuracy=1e-6, max_iterations=50, **kw):
+    """ fits the masses of N haloes from their projected density profiles `rho` (N x len(radii) array, Msun/kpc^2) with errors on ln(rho) `log_rho_err`,
+        with NFW profiles where the concentration is tied to the MC relation of `concentration_from_mc_relation`.
+        All haloes are fitted at once: ln(M) is first taken from a grid within `M_range` and then refined with Gauss-Newton steps
+        (halved if they increase the chi^2) until the step is below `accuracy`. Returns the arrays of masses and concentrations. """
+    log_rho = np.log(np.atleast_2d(np.asarray(rho, dtype=float)))
+    n = log_rho.shape[0]
+    radii = np.broadcast_to(np.asarray(radii, dtype=float), log_rho.shape)
+    log_rho_err = np.broadcast_to(np.asarray(log_rho_err, dtype=float), log_rho.shape)
+    a, omega_m, omega_b, sigma8, h0 = [np.broadcast_to(np.asarray(x, dtype=float), (n,)) for x in (a, omega_m, omega_b, sigma8, h0)]
+    def residuals(logM, halos):
+        M = np.exp(logM)
+        c = concentration_from_mc_relation(delta, M, a[halos], omega_m[halos], omega_b[halos], sigma8[halos], h0[halos], **kw)
+        model = projected_nfw_from_M_c(M[:,None], c[:,None], delta, a[halos,None], omega_m[halos,None], h0[halos,None], radii[halos])
+        return (np.log(model) - log_rho[halos])/log_rho_err[halos]
+    def chi2(logM, halos):
+        return np.sum(residuals(logM, halos)**2., axis=1)
+    halos = np.arange(n)
+    grid = np.linspace(np.log(M_range[0]), np.log(M_range[1]), 33)
+    chi2_grid = np.array([chi2(np.full(n, logM), halos) for logM in grid])
+    logM = grid[np.argmin(chi2_grid, axis=0)]
+    active = halos
+    h = 1e-5
+    for i in range(max_iterations):
+        if active.size==0:
+            break
+        x = logM[active]
+        r = residuals(x, active)
+        J = (residuals(x+h, active) - r)/h
+        step = -np.sum(J*r, axis=1)/np.sum(J*J, axis=1)
+        chi2_old = np.sum(r*r, axis=1)
+        for halving in range(20):
+            worse = chi2(x+step, active) > chi2_old
+            if not np.any(worse):
+                break
+            step = np.where(worse, 0.5*step, step)
+        logM[active] = x+step
+        active = active[np.abs(step)>=accuracy]
+    M = np.exp(logM)
+    return M, concentration_from_mc_relation(delta, M, a, omega_m, omega_b, sigma8, h0, **kw)
+
+def lognormal_chunks(mean, sigma, n, realizations=1, seed=None, chunk_size=100000, chunks=None, dtype=None):
+    """ yields (start, end, samples) for the chunks of `chunk_size` haloes, where samples is a realizations x (end-start) array of
+        mean(start, end)*exp(sigma*N(0,1)). Every chunk has its own random stream, spawned from `seed` with the chunk index,
+        so that the same seed and chunk_size give the same samples, also when the chunks in `chunks` are generated by different processes. """
+    dtype = np.dtype(float if dtype is None else dtype)
+    entropy = np.random.SeedSequence(seed).entropy
+    n_chunks = max(1, -(-n//chunk_size))
+    for chunk in (range(n_chunks) if chunks is None else chunks):
+        start, end = chunk*chunk_size, min((chunk+1)*chunk_size, n)
+        random_state = np.random.Generator(np.random.PCG64(np.random.SeedSequence(entropy, spawn_key=(chunk,))))
+        samples = random_state.standard_normal((realizations, end-start), dtype=dtype)
+        samples *= sigma
+        np.exp(samples, out=samples)
+        samples *= mean(start, end)
+        yield start, end, samples
+
+def halo_columns(*columns):
+    """ broadcasts the halo properties to the same number of haloes, returns the number of haloes and the flat columns """
+    columns = np.broadcast_arrays(*[np.asarray(x) for x in columns])
+    return columns[0].size, [x.reshape(-1) for x in columns]
+
+def sample_concentrations(delta, M, a, omega_m, omega_b, sigma8, h0, realizations=1, seed=None, chunk_size=100000, chunks=None, deltas_to=None,
+                          solver='newton', use_lite_mc_fit=False, use_lite_mc_dm_fit=False, table=None, sigma=None, dtype=None):
+    """ yields (start, end, samples) for every chunk of `chunk_size` haloes (or only for the chunk indices in `chunks`), where samples is a
+        realizations x (end-start) array of concentrations in `delta`, drawn from a lognormal around the MC relation of `concentration_from_mc_relation`
+        with the scatter `sigma` of its fit table (the last fit parameter). If `deltas_to` is a list of overdensities, samples is a dict of
+        concentrations in `delta` and in each of `deltas_to`, converted with `convert_concentration`. See `lognormal_chunks` for the random streams."""
+    if table is None:
+        table = mc_fit_table(delta, use_lite_mc_fit=use_lite_mc_fit, use_lite_mc_dm_fit=use_lite_mc_dm_fit)
+    if sigma is None:
+        sigma = table['params'][-1]
+    n, (M, a, omega_m, omega_b, sigma8, h0) = halo_columns(M, a, omega_m, omega_b, sigma8, h0)
+    mean = lambda start, end: concentration_from_mc_relation(delta, M[start:end], a[start:end], omega_m[start:end], omega_b[start:end], sigma8[start:end], h0[start:end],
+                                                             use_lite_mc_fit=use_lite_mc_fit, table=table, dtype=dtype)
+    for start, end, samples in lognormal_chunks(mean, sigma, n, realizations=realizations, seed=seed, chunk_size=chunk_size, chunks=chunks, dtype=dtype):
+        if deltas_to is None:
+            yield start, end, samples
+            continue
+        converted = {delta: samples}
+        for delta_to in deltas_to:
+            if delta_to!=delta:
+                converted[delta_to] = convert_concentration(delta, delta_to, samples, solver=solver, a=a[start:end], omega_m=omega_m[start:end], dtype=dtype)
+        yield start, end, converted
+
+def sample_masses(delta_from, delta_to, M, a, omega_m, omega_b, sigma8, h0, realizations=1, seed=None, chunk_size=100000, chunks=None, table=None, sigma=None, dtype=None):
+    """ same as `sample_concentrations`, but samples masses in `delta_to` around the MM relation of `mass_from_mm_relation` """
+    if table is None:
+        table = __mm_fit_parameters[delta_from][delta_to]
+    if sigma is None:
+        sigma = table['params'][-1]
+    n, (M, a, omega_m, omega_b, sigma8, h0) = halo_columns(M, a, omega_m, omega_b, sigma8, h0)
+    mean = lambda start, end: mass_from_mm_relation(delta_from, delta_to, M[start:end], a[start:end], omega_m[start:end], omega_b[start:end], sigma8[start:end], h0[start:end],
+                                                    table=table, dtype=dtype)
+    return lognormal_chunks(mean, sigma, n, realizations=realizations, seed=seed, chunk_size=chunk_size, chunks=chunks, dtype=dtype)
+
+relation_cache_size = 4096
+__relation_cache = collections.OrderedDict()
+transfer_cache_size = 32
+__transfer_cache = collections.OrderedDict()
+
+def cached_relation(key, build, cache=None, cache_size=None):
+    """ returns the relation memoized with `key` in a LRU cache of `relation_cache_size` elements, or builds it with `build()`.
+        `cache` and `cache_size` select another cache, e.g. the one of the matrices of `mass_function_transfer`.
+        Relations with unhashable keys (e.g. arrays of cosmologies) are not cached. """
+    cache = __relation_cache if cache is None else cache
+    cache_size = relation_cache_size if cache_size is None else cache_size
+    try:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    except TypeError:
+        return build()
+    relation = build()
+    cache[key] = relation
+    while len(cache) > cache_size:
+        cache.popitem(last=False)
+    return relation
+
+def table_key(table):
+    return (tuple(table['params']), tuple(sorted(table['pivots'].items())))
+
+def ragagnin2019_relation(A, B, C, pivots):
+    """ returns the function exp(A + B ln(M/M_pivot) + C ln(a/a_pivot)) of M and a """
+    M_pivot = pivots.get('M')
+    a_pivot = pivots.get('a')
+    def relation(M, a):
+        logM = np.log(np.array(M) / M_pivot) if M_pivot is not None else 0.
+        loga = np.log(np.array(a) / a_pivot) if a_pivot is not None else 0.
+        return np.exp(A + logM*B +  loga*C)
+    return relation
+
+def mc_relation(delta, omega_m, omega_b, sigma8, h0, use_lite_mc_fit=False, use_lite_mc_dm_fit=False, table=None):
+    """ returns the function c(M, a) of the MC relation of `concentration_from_mc_relation` for a given cosmology.
+        Coefficients A, B and C are computed once and relations are memoized by cosmology and fit table. """
+    if table is None:
+        table = mc_fit_table(delta, use_lite_mc_fit=use_lite_mc_fit, use_lite_mc_dm_fit=use_lite_mc_dm_fit)
+    def build():
+        A, B, C = ragagnin2019_coefficients(table['params'], table['pivots'], use_lite_mc_fit=use_lite_mc_fit, omega_m=omega_m, omega_b=omega_b, sigma8=sigma8, h0=h0)
+        return ragagnin2019_relation(A, B, C, table['pivots'])
+    return cached_relation(('mc', use_lite_mc_fit, table_key(table), (omega_m, omega_b, sigma8, h0)), build)
+
+def mm_relation(delta_from, delta_to, omega_m, omega_b, sigma8, h0, table=None):
+    """ returns the function M_delta_to(M, a) of the MM relation of `mass_from_mm_relation` for a given cosmology, memoized as in `mc_relation` """
+    if table is None:
+        table = __mm_fit_parameters[delta_from][delta_to]
+    def build():
+        A, B, C = ragagnin2019_coefficients(table['params'], table['pivots'], omega_m=omega_m, omega_b=omega_b, sigma8=sigma8, h0=h0)
+        return ragagnin2019_relation(A, B, C, table['pivots'])
+    return cached_relation(('mm', table_key(table), (omega_m, omega_b, sigma8, h0)), build)
+
+def mc_mass_relation(delta_from, delta_to, omega_m, omega_b, sigma8, h0, use_lite_mc_fit=False, use_lite_mc_dm_fit=False, table=None, solver='banach_caccioppoli', accuracy=None, max_iterations=None):
+    """ returns the function M_delta_to(M, a) of `mass_from_mc_relation` for a given cosmology, memoized as in `mc_relation`.
+        Overdensities are computed once, unless one of them depends on a (e.g. "vir" or "200m"). """
+    if table is None:
+        table = mc_fit_table(delta_from, use_lite_mc_fit=use_lite_mc_fit, use_lite_mc_dm_fit=use_lite_mc_dm_fit)
+    def build():
+        concentration = mc_relation(delta_from, omega_m, omega_b, sigma8, h0, use_lite_mc_fit=use_lite_mc_fit, table=table)
+        if delta_from.endswith('c') and delta_to.endswith('c'):
+            overdensities = (critical_overdensity(delta_from), critical_overdensity(delta_to))
+        else:
+            overdensities = None
+        def relation(M, a):
+            overdensity_from, overdensity_to = overdensities or (critical_overdensity(delta_from, a=a, omega_m=omega_m), critical_overdensity(delta_to, a=a, omega_m=omega_m))
+            c = concentration(M, a)
+            new_c = c2_bc(overdensity_to, overdensity_from, c, solver=solver, accuracy=accuracy, max_iterations=max_iterations)
+            return M* (overdensity_to/overdensity_from)*(new_c/c)**3.
+        return relation
+    return cached_relation(('mc_mass', delta_from, delta_to, use_lite_mc_fit, table_key(table), (omega_m, omega_b, sigma8, h0), solver, accuracy, max_iterations), build)
+
+def uniform_convolution_integral(t):
+    """ integral of the cumulative of the standard normal distribution, t*Phi(t) + phi(t) """
+    t = np.asarray(t, dtype=float)
+    erf = np.frompyfunc(math.erf, 1, 1)(t/np.sqrt(2.)).astype(float)
+    return t*0.5*(1.+erf) + np.exp(-0.5*t*t)/np.sqrt(2.*np.pi)
+
+def mass_function_transfer(delta_from, delta_to, M_from, M_to, a, omega_m, omega_b, sigma8, h0, relation='mc', scatter=False, sigma=None,
+                           use_lite_mc_fit=False, use_lite_mc_dm_fit=False, table=None, solver='newton', scatter_nodes=32):
+    """ returns the matrix T such that T @ dn/dlnM(delta_from) is the mass function dn/dlnM in `delta_to`, for mass functions binned
+        on the bin edges `M_from` (in delta_from) and `M_to` (in delta_to). Masses are converted with `mass_from_mc_relation` (relation='mc')
+        or `mass_from_mm_relation` (relation='mm'). The haloes of every input bin are spread uniformly in ln(M) over the image of the bin,
+        so that the Jacobian dlnM_to/dlnM_from is applied exactly and the number of haloes is conserved.
+        With scatter=True, the relation has a lognormal scatter of width `sigma` (by default the scatter of the fit table): for relation='mm'
+        the images are convolved with the scatter of ln(M_to), for relation='mc' the scatter of ln(c) is integrated with `scatter_nodes`
+        Gauss-Hermite nodes. Matrices are read-only and are memoized by cosmology, scale factor, overdensities and bins
+        in a LRU cache of `transfer_cache_size` matrices. """
+    if relation=='mc' and table is None:
+        table = mc_fit_table(delta_from, use_lite_mc_fit=use_lite_mc_fit, use_lite_mc_dm_fit=use_lite_mc_dm_fit)
+    elif relation=='mm' and table is None:
+        table = __mm_fit_parameters[delta_from][delta_to]
+    elif relation not in ('mc', 'mm'):
+        raise Exception('Unknown relation "%s", use "mc" or "mm"'%relation)
+    edges_from, edges_to = np.log(np.asarray(M_from, dtype=float)), np.log(np.asarray(M_to, dtype=float))
+    e, f = edges_to[:-1,None], edges_to[1:,None]
+    def bounds(image):
+        lo, hi = np.minimum(image[:-1], image[1:])[None,:], np.maximum(image[:-1], image[1:])[None,:]
+        return lo, hi, np.maximum(hi-lo, 1e-300)
+    def overlap(image):
+        # fraction of the image of input bin j that falls in output bin i
+        lo, hi, width = bounds(image)
+        return np.clip(np.minimum(f, hi) - np.maximum(e, lo), 0., None)/width
+    def build():
+        cosmology = dict(a=a, omega_m=omega_m, omega_b=omega_b, sigma8=sigma8, h0=h0)
+        scale = table['params'][-1] if sigma is None else sigma
+        if relation=='mc':
+            M = np.exp(edges_from)
+            c = concentration_from_mc_relation(delta_from, M, table=table, use_lite_mc_fit=use_lite_mc_fit, **cosmology)
+            nodes, weights = np.polynomial.hermite_e.hermegauss(scatter_nodes) if scatter else (np.zeros(1), np.ones(1))
+            images = np.log(mass_from_m_and_c(delta_from, delta_to, c[None,:]*np.exp(scale*nodes[:,None]), M=M, a=a, omega_m=omega_m, solver=solver))
+            fraction = sum(weight*overlap(image) for weight, image in zip(weights/np.sum(weights), images))
+        else:
+            image = np.log(mass_from_mm_relation(delta_from, delta_to, np.exp(edges_from), table=table, **cosmology))
+            if not scatter:
+                fraction = overlap(image)
+            else:
+                # uniform distribution on [lo, hi] convolved with a normal distribution, integrated over the output bin [e, f]
+                lo, hi, width = bounds(image)
+                G = uniform_convolution_integral
+                fraction = scale/width*(G((f-lo)/scale) - G((f-hi)/scale) - G((e-lo)/scale) + G((e-hi)/scale))
+        transfer = fraction*np.diff(edges_from)[None,:]/np.diff(edges_to)[:,None]
+        transfer.setflags(write=False)
+        return transfer
+    key = ('mass_function', relation, delta_from, delta_to, tuple(edges_from.tolist()), tuple(edges_to.tolist()), (a, omega_m, omega_b, sigma8, h0),
+           scatter, sigma, use_lite_mc_fit, table_key(table), solver, scatter_nodes)
+    return cached_relation(key, build, __transfer_cache, transfer_cache_size)
+
+def convert_mass_function(dn_dlnM, delta_from, delta_to, M_from, M_to, a, omega_m, omega_b, sigma8, h0, **kw):
+    """ converts the binned mass function dn/dlnM in `delta_from` (on the bin edges `M_from`) to the mass function in `delta_to` on the bin edges `M_to`
+        with the memoized matrix of `mass_function_transfer` (see there for the other arguments). `dn_dlnM` can have one column per mass function. """
+    return mass_function_transfer(delta_from, delta_to, M_from, M_to, a, omega_m, omega_b, sigma8, h0, **kw) @ np.asarray(dn_dlnM, dtype=float)
+
+def cosmology_grid(function, deltas, M, a, omega_m, omega_b, sigma8, h0, reduce=None, memory_budget=2**28, out=None,
+                   table=None, use_lite_mc_fit=False, use_lite_mc_dm_fit=False, solver='newton', accuracy=None, max_iterations=None):
+    """ evaluates `function` (concentration_from_mc_relation, mass_from_mm_relation or mass_from_mc_relation) on every pair of
+        N_cosmologies cosmologies (arrays omega_m, omega_b, sigma8, h0) and N_halos haloes (arrays M, a), with `deltas` the overdensity
+        (e.g. '200c') or the pair of overdensities (e.g. ('500c', 'vir')) of the function.
+        The coefficients A, B, C are computed once per cosmology, and the grid is evaluated in tiles of about `memory_budget` bytes.
+        With reduce=None returns the N_cosmologies x N_halos array (or writes it in `out`), with reduce='sum' or reduce='mean' returns
+        the sum or mean over haloes, and if `reduce` is a function reduce(values, haloes) of a tile of values and the slice of its haloes,
+        returns the sum over tiles of its results (e.g. the sum of log-likelihood terms of each cosmology)."""
+    if isinstance(deltas, str):
+        deltas = (deltas,)
+    cosmologies = np.broadcast_arrays(*[np.atleast_1d(np.asarray(x, dtype=float)) for x in (omega_m, omega_b, sigma8, h0)])
+    M, a = np.broadcast_arrays(np.atleast_1d(np.asarray(M, dtype=float)), np.atleast_1d(np.asarray(a, dtype=float)))
+    n_cosmologies, n_halos = len(cosmologies[0]), len(M)
+    if function is mass_from_mm_relation:
+        if table is None:
+            table = __mm_fit_parameters[deltas[0]][deltas[1]]
+        use_lite_mc_fit = False
+    elif function in (concentration_from_mc_relation, mass_from_mc_relation):
+        if table is None:
+            table = mc_fit_table(deltas[0], use_lite_mc_fit=use_lite_mc_fit, use_lite_mc_dm_fit=use_lite_mc_dm_fit)
+    else:
+        raise Exception('cosmology_grid supports concentration_from_mc_relation, mass_from_mm_relation and mass_from_mc_relation')
+    pivots = table['pivots']
+    A, B, C = [np.broadcast_to(x, (n_cosmologies,))[:,None] for x in ragagnin2019_coefficients(table['params'], pivots, use_lite_mc_fit=use_lite_mc_fit,
+                                                                                              omega_m=cosmologies[0], omega_b=cosmologies[1], sigma8=cosmologies[2], h0=cosmologies[3])]
+    logM = np.log(M / pivots['M']) if 'M' in pivots else np.zeros(n_halos)
+    loga = np.log(a / pivots['a']) if 'a' in pivots else np.zeros(n_halos)
+    # a tile needs about 4 temporary arrays of 8 bytes per element
+    elements = max(1, memory_budget//32)
+    rows = min(n_cosmologies, max(1, elements//n_halos))
+    columns = min(n_halos, max(1, elements//rows))
+    if reduce is None:
+        result = np.empty((n_cosmologies, n_halos)) if out is None else out
+    else:
+        result = np.zeros(n_cosmologies)
+    for row in range(0, n_cosmologies, rows):
+        r = slice(row, row+rows)
+        for column in range(0, n_halos, columns):
+            h = slice(column, column+columns)
+            values = np.exp(A[r] + logM[None,h]*B[r] + loga[None,h]*C[r])
+            if function is mass_from_mc_relation:
+                overdensity_from, overdensity_to = [critical_overdensity(delta, a=a[None,h], omega_m=cosmologies[0][r,None]) for delta in deltas]
+                new_c = c2_bc(overdensity_to, overdensity_from, values, solver=solver, accuracy=accuracy, max_iterations=max_iterations)
+                values = M[None,h]*(overdensity_to/overdensity_from)*(new_c/values)**3.
+            if reduce is None:
+                result[r,h] = values
+            elif reduce=='sum' or reduce=='mean':
+                result[r] += np.sum(values, axis=1)
+            else:
+                result[r] += reduce(values, h)
+    if reduce=='mean':
+        result /= n_halos
+    return result
+
+@profiled('delta_from')
+def convert_all_deltas(delta_from, M, a=None, omega_m=None, omega_b=None, sigma8=None, h0=None, c=None, deltas=None, solver='newton', **kw):
+    """ returns a dict with the pair (mass, concentration) of the halo in each overdensity of `deltas` (default: 200c, 500c, 2500c, vir, 200m),
+        given its mass M in `delta_from` and its concentration `c` (if None, it is taken from the MC relation as in `concentration_from_mc_relation`).
+        The concentration is converted to all overdensities with a single solve. """
+    if deltas is None:
+        deltas = __deltas
+    if c is None:
+        c = concentration_from_mc_relation(delta_from, M, a, omega_m, omega_b, sigma8, h0, **kw)
+    overdensity_from = critical_overdensity(delta_from, a=a, omega_m=omega_m)
+    targets = [delta for delta in deltas if delta!=delta_from]
+    ratios = [critical_overdensity(delta, a=a, omega_m=omega_m)/overdensity_from for delta in targets]
+    M, c = np.asarray(M, dtype=float), np.asarray(c, dtype=float)
+    shape = np.broadcast_shapes(M.shape, c.shape, *[np.shape(ratio) for ratio in ratios])
+    M, c = np.broadcast_to(M, shape), np.broadcast_to(c, shape)
+    ratios = np.stack([np.broadcast_to(ratio, shape) for ratio in ratios]) if targets else np.zeros((0,)+shape)
+    new_c = c2_bc(ratios, 1., c, solver=solver, accuracy=kw.get('accuracy'), max_iterations=kw.get('max_iterations'))
+    result = {}
+    for delta in deltas:
+        if delta==delta_from:
+            new_M, new_c_delta = M, c
+        else:
+            i = targets.index(delta)
+            new_M, new_c_delta = M * ratios[i]*(new_c[i]/c)**3., new_c[i]
+        result[delta] = (new_M[()], new_c_delta[()])
+    return result
+
+def array_arguments(args, kw):
+    """ returns the positions in `args` and the keys in `kw` of the array arguments of a call, their values, their broadcast shape and size """
+    keys = [i for i, value in enumerate(args) if np.ndim(value)>0] + [key for key, value in kw.items() if np.ndim(value)>0 and not callable(value) and not isinstance(value, dict)]
+    values = [args[key] if isinstance(key, int) else kw[key] for key in keys]
+    shape = np.broadcast_shapes(*[np.shape(value) for value in values]) if values else ()
+    return keys, values, shape, int(np.prod(shape))
+
+def chunked_call(function, *args, **kw):
+    """ calls `function(*args, **kw)` on chunks of `chunk_size` elements of the array arguments, e.g. memory-mapped inputs from
+        `np.load(path, mmap_mode='r')`, and writes every chunk in `out` (allocated if None), e.g. a memory-mapped output from
+        `np.lib.format.open_memmap(path, mode='w+', dtype=float, shape=...)`. Every chunk of `out` is given to `function` as its `out`
+        and a single buffer of `chunk_size` elements as its `scratch`, so that with solver='newton' or solver='table' the memory used
+        is a small multiple of `chunk_size` and not of the number of haloes. """
+    chunk_size = kw.pop('chunk_size', 100000)
+    out = kw.pop('out', None)
+    parameters = inspect.signature(function).parameters
+    keywords = any(parameter.kind==inspect.Parameter.VAR_KEYWORD for parameter in parameters.values())
+    keys, values, shape, n = array_arguments(args, kw)
+    values = [np.broadcast_to(value, shape).reshape(-1) for value in values]
+    if out is None:
+        out = np.empty(shape, dtype=kw.get('dtype') or float)
+    result = out.reshape(-1)
+    scratch = np.empty(min(chunk_size, n), dtype=out.dtype) if 'scratch' in parameters or keywords else None
+    args = list(args)
+    for start in range(0, n, chunk_size):
+        end = min(start+chunk_size, n)
+        for key, value in zip(keys, values):
+            if isinstance(key, int):
+                args[key] = value[start:end]
+            else:
+                kw[key] = value[start:end]
+        if 'out' in parameters or keywords:
+            kw['out'] = result[start:end]
+        if scratch is not None:
+            kw['scratch'] = scratch[:end-start]
+        chunk = function(*args, **kw)
+        if chunk is not result[start:end] and not np.shares_memory(chunk, result[start:end]):
+            result[start:end] = chunk
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out[()] if out.ndim==0 else out
+
+def memmap_location(value):
+    """ returns (filename, byte offset) of the data of a memory-mapped array, or of a view of it, or None if `value` is not memory-mapped.
+        The `offset` attribute of np.memmap is not updated when it is sliced, so the offset is computed from the array that owns the mapping. """
+    base = value
+    while isinstance(base, np.ndarray) and not isinstance(base.base, mmap.mmap):
+        base = base.base
+    if not isinstance(base, np.memmap) or base.filename is None:
+        return None
+    return base.filename, base.offset + value.ctypes.data - base.ctypes.data
+
+def parallel_chunk(task):
+    """ evaluates one chunk of `parallel_call`: array arguments and output are memory-mapped files described by (filename, offset, size) """
+    function, args, kw, arrays, output, start, end = task
+    args = list(args)
+    for key, (filename, offset, size) in arrays:
+        value = np.memmap(filename, dtype=float, mode='r', offset=offset, shape=(size,))[start:end]
+        if isinstance(key, int):
+            args[key] = value
+        else:
+            kw[key] = value
+    out = np.memmap(output[0], dtype=float, mode='r+', offset=output[1], shape=(output[2],))
+    out[start:end] = function(*args, **kw)
+    out.flush()
+    return end-start
+
+def parallel_call(function, *args, **kw):
+    """ calls `function(*args, **kw)` on `workers` processes (default: number of CPUs), splitting the array arguments in chunks of `chunk_size` elements.
+        Arrays are passed to the workers as memory-mapped files (`np.memmap` arguments are used in place) and every worker writes its chunk
+        in a preallocated memory-mapped output, which is returned in the original order (or written in `out`, if provided).
+        `function` must be a module level function (e.g. concentration_from_mc_relation, mass_from_mm_relation, mass_from_mc_relation or convert_concentration).
+        Results are bit-identical to the serial call only for element-wise solvers, so functions that solve the NFW equation require solver='newton' or solver='table'."""
+    workers = kw.pop('workers', None)
+    chunk_size = kw.pop('chunk_size', 100000)
+    out = kw.pop('out', None)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    parameters = inspect.signature(function).parameters
+    if 'solver' in parameters and kw.get('solver', parameters['solver'].default)=='banach_caccioppoli' and not kw.get('c_hu_kratsov_2002'):
+        raise Exception('parallel_call needs an element-wise solver, use solver="newton" or solver="table"')
+    if kw.get('solver')=='table':
+        nfw_table()
+    keys, values, shape, n = array_arguments(args, kw)
+    directory = tempfile.mkdtemp(prefix='hydro_mc_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    try:
+        arrays = []
+        for i, (key, value) in enumerate(zip(keys, values)):
+            location = memmap_location(value) if isinstance(value, np.memmap) and value.dtype==float and value.shape==shape and value.flags['C_CONTIGUOUS'] and value.mode!='c' else None
+            if location is not None:
+                arrays.append((key, location + (n,)))
+                continue
+            filename = os.path.join(directory, 'argument_%d.dat'%i)
+            array = np.memmap(filename, dtype=float, mode='w+', shape=shape)
+            array[...] = value
+            array.flush()
+            del array
+            arrays.append((key, (filename, 0, n)))
+        location = memmap_location(out) if isinstance(out, np.memmap) and out.dtype==float and out.size==n and out.flags['C_CONTIGUOUS'] and out.mode in ('r+', 'w+') else None
+        if location is not None:
+            out.flush()
+            output = location + (n,)
+        else:
+            output = (os.path.join(directory, 'output.dat'), 0, n)
+            np.memmap(output[0], dtype=float, mode='w+', shape=(n,)).flush()
+        args = tuple(None if i in keys else value for i, value in enumerate(args))
+        kw = dict((key, value) for key, value in kw.items() if key not in keys)
+        tasks = [(function, args, kw, arrays, output, start, min(start+chunk_size, n)) for start in range(0, n, chunk_size)]
+        if workers<=1 or len(tasks)<=1:
+            list(map(parallel_chunk, tasks))
+        else:
+            pool = multiprocessing.Pool(min(workers, len(tasks)))
+            try:
+                pool.map(parallel_chunk, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        result = np.memmap(output[0], dtype=float, mode='r', offset=output[1], shape=(n,))
+        if out is not None:
+            if location is None:
+                out.reshape(-1)[...] = result
+            return out
+        result = np.array(result).reshape(shape)
+        return result[()] if result.ndim==0 else result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
 
 def split_kv(a,d, names,prekey=''):
     for arg in a:
@@ -239,7 +1248,512 @@ def split_kv(a,d, names,prekey=''):
             d[prekey+k]=float(v)
         except Exception as e:
             raise Exception('Value  must be floats, in "%s" found "%s"'%(arg, v))
-def main():
+__catalog_columns = ['M','a','omega_m','omega_b','sigma8','h0','c']
+
+def all_deltas_results(args, kw):
+    results = convert_all_deltas(args.delta1, **kw)
+    return [x for delta in __deltas for x in results[delta]]
+
+def catalog_operations(args, columns=()):
+    """ returns a list of (names, function, required columns) of the operations selected in the command line, where `columns` are the columns of the catalog;
+        each function takes the dict of arguments and returns one array per name """
+    operations = []
+    relation_columns = [] if args.personalise_fit_parameters else __fit_pivot_names
+    args.concentration_from_mc_relation and operations.append((['c_%s'%args.delta1], lambda kw: [concentration_from_mc_relation(args.delta1, **kw)], relation_columns))
+    args.concentration_from_c and operations.append((['c_%s'%args.delta2], lambda kw: [convert_concentration(args.delta1, args.delta2, kw['c'], **kw)], ['c']))
+    args.mass_from_mm_relation and not args.inverse and operations.append((['M_%s'%args.delta2], lambda kw: [mass_from_mm_relation(args.delta1, args.delta2, **kw)], relation_columns))
+    args.mass_from_mc_relation and not args.inverse and operations.append((['M_%s'%args.delta2], lambda kw: [mass_from_mc_relation(args.delta1, args.delta2, **kw)], relation_columns))
+    args.mass_from_mm_relation and args.inverse and operations.append((['M_%s'%args.delta1], lambda kw: [inverse_mass_from_mm_relation(args.delta1, args.delta2, **kw)], relation_columns))
+    args.mass_from_mc_relation and args.inverse and operations.append((['M_%s'%args.delta1], lambda kw: [inverse_mass_from_mc_relation(args.delta1, args.delta2, **kw)], relation_columns))
+    args.mass_from_mass_and_c and operations.append((['M_%s'%args.delta2], lambda kw: [mass_from_m_and_c(args.delta1, args.delta2, kw['c'], **kw)], ['M','c']))
+    args.all_deltas and operations.append(([x%delta for delta in __deltas for x in ('M_%s', 'c_%s')], lambda kw: all_deltas_results(args, kw),
+                                           ['M','a','omega_m'] + ([] if args.c is not None or 'c' in columns else relation_columns)))
+    return operations
+
+def catalog_extension(path):
+    return os.path.splitext(path)[1].lower()
+
+def catalog_length(path):
+    """ number of haloes in a catalog file (.csv, .txt, .npy, .npz, .hdf5 or .h5) """
+    extension = catalog_extension(path)
+    if extension in ('.npy', '.npz'):
+        data = np.load(path, mmap_mode='r')
+        return len(data) if extension=='.npy' else len(data[data.files[0]])
+    elif extension in ('.hdf5', '.h5'):
+        import h5py
+        with h5py.File(path, 'r') as f:
+            return len(f[list(f.keys())[0]])
+    else:
+        with open(path) as f:
+            return sum(1 for line in f if line.strip() and not line.startswith('#')) - 1
+
+def catalog_chunks(path, chunk_size=100000):
+    """ iterates over a catalog file in chunks of `chunk_size` haloes, every chunk is a dict of column name and array.
+        CSV files must have a header line with the column names, .npy files must contain a structured array,
+        .npz and HDF5 files must contain one dataset per column. Only .npz files are read as a whole. """
+    extension = catalog_extension(path)
+    if extension=='.npy':
+        data = np.load(path, mmap_mode='r')
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start:start+chunk_size]
+            yield dict((name, np.asarray(chunk[name], dtype=float)) for name in data.dtype.names)
+    elif extension=='.npz':
+        data = np.load(path)
+        columns = dict((name, data[name]) for name in data.files)
+        n = len(columns[data.files[0]])
+        for start in range(0, n, chunk_size):
+            yield dict((name, np.asarray(column[start:start+chunk_size], dtype=float)) for name, column in columns.items())
+    elif extension in ('.hdf5', '.h5'):
+        import h5py
+        with h5py.File(path, 'r') as f:
+            names = list(f.keys())
+            n = len(f[names[0]])
+            for start in range(0, n, chunk_size):
+                yield dict((name, np.asarray(f[name][start:start+chunk_size], dtype=float)) for name in names)
+    else:
+        with open(path) as f:
+            lines = (line for line in f if line.strip() and not line.startswith('#'))
+            names = [name.strip() for name in next(lines).split(',')]
+            while True:
+                chunk = list(itertools.islice(lines, chunk_size))
+                if len(chunk)==0:
+                    break
+                values = np.loadtxt(chunk, delimiter=',', ndmin=2)
+                yield dict((name, values[:,i]) for i, name in enumerate(names))
+
+__catalog_output_extensions = ['.csv', '.txt', '.npy', '.hdf5', '.h5']
+
+def write_catalog(path, names, length, chunks):
+    """ writes the chunks of results (dicts of name and array) in a .csv, .npy (structured array) or HDF5 file of `length` haloes.
+        The file is written to a temporary file in the same directory, which replaces `path` only once all chunks are written. """
+    extension = catalog_extension(path)
+    extension in __catalog_output_extensions or panic('Output file %s must have one of the extensions %s'%(path, ', '.join(__catalog_output_extensions)))
+    descriptor, temporary = tempfile.mkstemp(prefix=os.path.basename(path)+'.', suffix=extension, dir=os.path.dirname(os.path.abspath(path)))
+    os.close(descriptor)
+    try:
+        write_catalog_file(temporary, extension, names, length, chunks)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temporary, 0o666 & ~umask)
+        os.replace(temporary, path)
+    finally:
+        os.path.exists(temporary) and os.remove(temporary)
+
+def write_catalog_file(path, extension, names, length, chunks):
+    if extension=='.npy':
+        output = np.lib.format.open_memmap(path, mode='w+', dtype=[(name, float) for name in names], shape=(length,))
+        start = 0
+        for chunk in chunks:
+            n = len(chunk[names[0]])
+            for name in names:
+                output[name][start:start+n] = chunk[name]
+            start += n
+        output.flush()
+    elif extension in ('.hdf5', '.h5'):
+        import h5py
+        with h5py.File(path, 'w') as f:
+            datasets = [f.create_dataset(name, (length,), dtype=float) for name in names]
+            start = 0
+            for chunk in chunks:
+                n = len(chunk[names[0]])
+                for name, dataset in zip(names, datasets):
+                    dataset[start:start+n] = chunk[name]
+                start += n
+    else:
+        with open(path, 'w') as f:
+            f.write(','.join(names)+'\n')
+            for chunk in chunks:
+                np.savetxt(f, np.column_stack([chunk[name] for name in names]), delimiter=',', fmt='%.8e')
+
+def convert_catalog(args):
+    """ runs the operations selected in the command line on the catalog --catalog and writes the results to --output, chunk by chunk """
+    chunks = catalog_chunks(args.catalog, chunk_size=args.chunk_size)
+    first_chunk = next(chunks, None)
+    operations = catalog_operations(args, () if first_chunk is None else first_chunk.keys())
+    len(operations)==0 and panic('With --catalog you must use one of --concentration-from-mc-relation, --concentration-from-c, --mass-from-mm-relation, --mass-from-mc-relation, --mass-from-mass-and-c or --all-deltas')
+    args.output is None and panic('With --catalog you must set the output file via --output')
+    names = [name for operation_names, function, columns in operations for name in operation_names]
+    len(set(names))<len(names) and panic('The operations %s write the same output column'%', '.join(names))
+    if first_chunk is not None:
+        missing = [column for operation_names, function, columns in operations for column in columns if column not in first_chunk and args.__dict__.get(column) is None]
+        missing and panic('Column(s) %s missing in %s, add them to the catalog or set them from command line'%(', '.join(sorted(set(missing))), args.catalog))
+    length = catalog_length(args.catalog)
+    def results():
+        halos = 0
+        start = time.time()
+        for chunk in itertools.chain([] if first_chunk is None else [first_chunk], chunks):
+            kw = dict(args.__dict__)
+            kw.update((name, chunk[name]) for name in __catalog_columns if name in chunk)
+            n = len(chunk[list(chunk.keys())[0]])
+            yield dict((name, np.broadcast_to(value, (n,))) for operation_names, function, columns in operations for name, value in zip(operation_names, function(kw)))
+            halos += n
+        elapsed = time.time()-start
+        sys.stderr.write('Converted %d haloes in %.2f s (%.3e haloes/s)\n'%(halos, elapsed, halos/elapsed if elapsed>0. else float('inf')))
+    write_catalog(args.output, names, length, results())
+
+__service_defaults = None
+__service_keys = ['delta1', 'delta2', 'concentration_from_mc_relation', 'concentration_from_c', 'mass_from_mc_relation', 'mass_from_mm_relation', 'inverse',
+                  'mass_from_mass_and_c', 'all_deltas', 'concentration_hu_kratsov_2002', 'use_lite_mc_fit', 'use_lite_mc_dm_fit', 'solver', 'accuracy', 'max_iterations']
+
+def service_args(request):
+    """ returns the command line arguments of a JSON request: keys are the halo columns, the command line options of `__service_keys`
+        with "_" in place of "-", and set_pivots and set_fit_parameters as dicts of pivots and fit parameters. Other keys
+        (e.g. show_fit_parameters or options of the command line only like catalog) are rejected. """
+    global __service_defaults
+    if __service_defaults is None:
+        __service_defaults = vars(argument_parser().parse_args([]))
+    args = argparse.Namespace(**__service_defaults)
+    args.personalise_fit_parameters = False
+    args.solver = 'newton'
+    for key, value in request.items():
+        if key in ('id', 'set_pivots', 'set_fit_parameters') or key in __catalog_columns:
+            continue
+        if key not in __service_keys:
+            raise Exception('Unknown request parameter "%s", use one of %s'%(key, ', '.join(['id', 'set_pivots', 'set_fit_parameters'] + __catalog_columns + __service_keys)))
+        setattr(args, key, value)
+    if request.get('set_pivots'):
+        split_kv(['%s=%s'%(k, v) for k, v in request['set_pivots'].items()], args.__dict__, __fit_pivot_names, prekey='pivot_')
+        args.personalise_fit_parameters = True
+        split_kv(['%s=%s'%(k, v) for k, v in request.get('set_fit_parameters', {}).items()], args.__dict__, __fit_parameter_names)
+    args.table = fit_table_from_args(args)
+    return args
+
+def service_request_columns(request, columns):
+    """ returns the columns of a request as 1D arrays broadcast to the same length, and their length """
+    values = [np.atleast_1d(np.asarray(request[name], dtype=float)) for name in columns]
+    for name, value in zip(columns, values):
+        value.ndim>1 and panic_exception('Parameter %s must be a number or a list of numbers'%name)
+    n = np.broadcast_shapes(*[value.shape for value in values])[0] if values else 1
+    return [np.broadcast_to(value, (n,)) for value in values], n
+
+def service_evaluate(requests, items, args, columns, operations, responses):
+    """ evaluates the requests `items` (list of index, columns and length) of the same group in a single vectorized call and writes their responses """
+    kw = dict(args.__dict__)
+    for j, name in enumerate(columns):
+        kw[name] = np.concatenate([value[j] for i, value, n in items])
+    total = sum(n for i, value, n in items)
+    # responses are written on stdout, so nothing else may be printed there
+    with contextlib.redirect_stdout(sys.stderr):
+        results = [(name, np.broadcast_to(value, (total,))) for operation_names, function, required in operations for name, value in zip(operation_names, function(kw))]
+    # NaN and infinities are not valid JSON, they are answered as null
+    json_value = lambda x: float(x) if np.isfinite(x) else None
+    start = 0
+    for i, value, n in items:
+        scalar = all(np.ndim(requests[i][name])==0 for name in columns)
+        responses[i] = {'id': requests[i].get('id'), 'result': dict((name, json_value(value[start]) if scalar else [json_value(x) for x in value[start:start+n]]) for name, value in results)}
+        start += n
+
+def service_error(request, e):
+    return {'id': request.get('id') if isinstance(request, dict) else None, 'error': '%s: %s'%(type(e).__name__, str(e))}
+
+def service_batch(requests):
+    """ answers a list of JSON requests (dicts); requests with the same operation and parameters are evaluated together in a single vectorized call.
+        If the vectorized call fails, the requests of the group are evaluated one by one, so that errors are reported only to the requests that cause them. """
+    responses = [None]*len(requests)
+    groups = collections.OrderedDict()
+    for i, request in enumerate(requests):
+        try:
+            if not isinstance(request, dict):
+                raise Exception('Requests must be JSON objects')
+            columns = tuple(sorted(name for name in __catalog_columns if request.get(name) is not None))
+            key = json.dumps(dict((k, v) for k, v in request.items() if k!='id' and k not in __catalog_columns), sort_keys=True) + repr(columns)
+            groups.setdefault(key, []).append(i)
+        except Exception as e:
+            responses[i] = service_error(request, e)
+    for key, indices in groups.items():
+        try:
+            args = service_args(requests[indices[0]])
+            columns = [name for name in __catalog_columns if requests[indices[0]].get(name) is not None]
+            operations = catalog_operations(args, columns)
+            len(operations)==0 and panic_exception('Requests must set one of concentration_from_mc_relation, concentration_from_c, mass_from_mm_relation, mass_from_mc_relation, mass_from_mass_and_c or all_deltas')
+            missing = [column for operation_names, function, required in operations for column in required if column not in columns and args.__dict__.get(column) is None]
+            missing and panic_exception('Parameter(s) %s missing'%', '.join(missing))
+        except Exception as e:
+            for i in indices:
+                responses[i] = service_error(requests[i], e)
+            continue
+        items = []
+        for i in indices:
+            try:
+                items.append((i,) + tuple(service_request_columns(requests[i], columns)))
+            except Exception as e:
+                responses[i] = service_error(requests[i], e)
+        try:
+            items and service_evaluate(requests, items, args, columns, operations, responses)
+        except Exception as e:
+            if len(items)==1:
+                responses[items[0][0]] = service_error(requests[items[0][0]], e)
+                continue
+            for item in items:
+                try:
+                    service_evaluate(requests, [item], args, columns, operations, responses)
+                except Exception as e:
+                    responses[item[0]] = service_error(requests[item[0]], e)
+    return responses
+
+def panic_exception(x):
+    raise Exception(x)
+
+def serve(stdin=True, socket_path=None, max_batch=4096):
+    """ answers JSON-lines requests from stdin (responses are written to stdout) and from the clients of the Unix socket `socket_path`.
+        All requests that are available at the same time (up to `max_batch`) are answered together with `service_batch`. """
+    import selectors
+    import socket
+    selector = selectors.DefaultSelector()
+    buffers = {}
+    if stdin:
+        selector.register(sys.stdin.fileno(), selectors.EVENT_READ, 'stdin')
+        buffers['stdin'] = b''
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(128)
+        selector.register(server, selectors.EVENT_READ, 'server')
+    def disconnect(source):
+        if source in buffers:
+            selector.unregister(source)
+            buffers.pop(source)
+        source.close()
+    try:
+        while len(buffers)>0 or socket_path is not None:
+            pending = []
+            closing = []
+            for key, mask in selector.select():
+                if key.data=='server':
+                    connection, address = server.accept()
+                    selector.register(connection, selectors.EVENT_READ, connection)
+                    buffers[connection] = b''
+                    continue
+                source = key.data
+                try:
+                    data = os.read(key.fd, 65536) if source=='stdin' else source.recv(65536)
+                except OSError:
+                    if source=='stdin':
+                        raise
+                    disconnect(source)
+                    continue
+                if not data:
+                    # the last line may not end with a newline: it is answered before closing the connection
+                    selector.unregister(key.fileobj)
+                    line = buffers.pop(source)
+                    line.strip() and pending.append((source, line))
+                    closing.append(source)
+                    continue
+                lines = (buffers[source]+data).split(b'\n')
+                buffers[source] = lines.pop()
+                pending.extend((source, line) for line in lines if line.strip())
+            for start in range(0, len(pending), max_batch):
+                batch = pending[start:start+max_batch]
+                requests = []
+                for source, line in batch:
+                    try:
+                        requests.append(json.loads(line))
+                    except ValueError as e:
+                        requests.append(None)
+                responses = service_batch([request if request is not None else {} for request in requests])
+                for (source, line), request, response in zip(batch, requests, responses):
+                    if request is None:
+                        response = {'id': None, 'error': 'Invalid JSON request'}
+                    try:
+                        output = (json.dumps(response, allow_nan=False)+'\n').encode()
+                    except ValueError as e:
+                        output = (json.dumps(service_error(response, e))+'\n').encode()
+                    if source=='stdin':
+                        sys.stdout.buffer.write(output)
+                    elif source.fileno()>=0:
+                        try:
+                            source.sendall(output)
+                        except OSError:
+                            # the client disconnected before reading its response
+                            disconnect(source)
+                sys.stdout.flush()
+            for source in closing:
+                source!='stdin' and source.close()
+    finally:
+        if socket_path is not None:
+            server.close()
+            os.path.exists(socket_path) and os.unlink(socket_path)
+
+def reference_c2(delta2, delta1, c1, iterations=80):
+    """ high precision reference of the NFW concentration conversion: bisection on ln(c2) in extended precision (np.longdouble),
+        iterated well beyond the resolution of float64 """
+    c1, delta2, delta1 = [np.asarray(x, dtype=np.longdouble) for x in (c1, delta2, delta1)]
+    log_ratio = np.log(delta2/delta1)
+    u1 = np.log(c1)
+    target = 3.*u1 - np.log(f_NFW(c1)) - log_ratio
+    # 1 <= G' <= 3 for NFW, see c2_newton
+    lo = u1 - np.maximum(log_ratio, log_ratio/3.)
+    hi = u1 - np.minimum(log_ratio, log_ratio/3.)
+    lo, hi, target = np.broadcast_arrays(lo - 1e-3, hi + 1e-3, target)
+    lo, hi = lo.copy(), hi.copy()
+    for i in range(iterations):
+        middle = 0.5*(lo+hi)
+        above = 3.*middle - np.log(f_NFW(np.exp(middle))) > target
+        hi = np.where(above, middle, hi)
+        lo = np.where(above, lo, middle)
+    return np.exp(0.5*(lo+hi))
+
+benchmark_sizes = [10**i for i in range(8)]
+benchmark_solvers = ['banach_caccioppoli', 'newton', 'table']
+
+def benchmark_inputs(size, seed=0):
+    """ random haloes and cosmologies within the range of the fits, the same for a given `seed` """
+    random_state = np.random.RandomState(seed)
+    uniform = lambda low, high: random_state.uniform(low, high, size)
+    return {'M': np.exp(uniform(np.log(1e13), np.log(1e15))), 'a': uniform(0.5, 1.), 'omega_m': uniform(0.2, 0.4), 'omega_b': uniform(0.04, 0.05),
+            'sigma8': uniform(0.7, 0.9), 'h0': uniform(0.65, 0.75), 'c': uniform(2., 10.)}
+
+def benchmark_cases(deltas=None, deltas_to=None, solvers=None):
+    """ yields (function name, delta_from, delta_to, solver, function of the inputs, reference function of the inputs in extended precision)
+        for every public conversion, pair of overdensities and solver """
+    deltas = __deltas if deltas is None else deltas
+    deltas_to = __deltas if deltas_to is None else deltas_to
+    solvers = benchmark_solvers if solvers is None else solvers
+    def mass_from_c(delta_from, delta_to, M, c, **kw):
+        overdensity_from, overdensity_to = critical_overdensity(delta_from, **kw), critical_overdensity(delta_to, **kw)
+        return M*(overdensity_to/overdensity_from)*(reference_c2(overdensity_to, overdensity_from, c)/c)**3.
+    for delta in deltas:
+        yield ('concentration_from_mc_relation', delta, None, None, lambda kw, delta=delta: concentration_from_mc_relation(delta, **kw),
+               lambda kw, delta=delta: concentration_from_mc_relation(delta, **kw))
+    for delta_from in deltas:
+        for delta_to in __mm_fit_parameters.get(delta_from, {}):
+            if delta_to in deltas_to:
+                yield ('mass_from_mm_relation', delta_from, delta_to, None, lambda kw, d=(delta_from, delta_to): mass_from_mm_relation(*d, **kw),
+                       lambda kw, d=(delta_from, delta_to): mass_from_mm_relation(*d, **kw))
+    pairs = [(delta_from, delta_to) for delta_from in deltas for delta_to in deltas_to if delta_from!=delta_to]
+    for delta_from, delta_to in pairs:
+        reference = lambda kw, d=(delta_from, delta_to): reference_c2(critical_overdensity(d[1], **kw), critical_overdensity(d[0], **kw), kw['c'])
+        for solver in solvers:
+            yield ('convert_concentration', delta_from, delta_to, solver, lambda kw, d=(delta_from, delta_to), s=solver: convert_concentration(d[0], d[1], kw['c'], solver=s, a=kw['a'], omega_m=kw['omega_m']), reference)
+        yield ('convert_concentration', delta_from, delta_to, 'c_hu_kratsov_2002', lambda kw, d=(delta_from, delta_to): convert_concentration(d[0], d[1], kw['c'], c_hu_kratsov_2002=True, a=kw['a'], omega_m=kw['omega_m']), reference)
+    for delta_from, delta_to in pairs:
+        for solver in solvers:
+            yield ('mass_from_m_and_c', delta_from, delta_to, solver, lambda kw, d=(delta_from, delta_to), s=solver: mass_from_m_and_c(d[0], d[1], kw['c'], solver=s, M=kw['M'], a=kw['a'], omega_m=kw['omega_m']),
+                   lambda kw, d=(delta_from, delta_to): mass_from_c(d[0], d[1], kw['M'], kw['c'], a=kw['a'], omega_m=kw['omega_m']))
+    for delta_from, delta_to in pairs:
+        for solver in solvers:
+            yield ('mass_from_mc_relation', delta_from, delta_to, solver, lambda kw, d=(delta_from, delta_to), s=solver: mass_from_mc_relation(d[0], d[1], solver=s, **kw),
+                   lambda kw, d=(delta_from, delta_to): mass_from_c(d[0], d[1], kw['M'], concentration_from_mc_relation(d[0], **kw), a=kw['a'], omega_m=kw['omega_m']))
+
+def time_call(function, min_time=0.05, repeat=3, max_time=1.):
+    """ returns the result of function() and the best time of a call over `repeat` runs; every run calls function() enough times to last `min_time`,
+        runs stop once they take more than `max_time` """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            result = function()
+        elapsed = time.perf_counter()-start
+        if elapsed>=min_time:
+            break
+        number *= 10
+    best = elapsed
+    for i in range(repeat-1):
+        if elapsed>max_time:
+            break
+        start = time.perf_counter()
+        for i in range(number):
+            function()
+        elapsed = time.perf_counter()-start
+        best = min(best, elapsed)
+    return result, best/number
+
+def check_parallel_call(size=1000, workers=2, seed=0):
+    """ returns a dict of checks that `parallel_call` is bit-identical to the serial call of mass_from_mc_relation with solver='newton'
+        on arrays, on a slice of a memory-mapped input and with a slice of a memory-mapped output """
+    inputs = benchmark_inputs(2*size, seed=seed)
+    directory = tempfile.mkdtemp(prefix='hydro_mc_')
+    try:
+        filename = os.path.join(directory, 'M.npy')
+        np.save(filename, inputs['M'])
+        M = np.load(filename, mmap_mode='r')[size:]
+        kw = dict((key, inputs[key][size:]) for key in ('a', 'omega_m', 'omega_b', 'sigma8', 'h0'))
+        expected = mass_from_mc_relation('200c', '500c', np.array(M), solver='newton', **kw)
+        call = lambda M, **args: parallel_call(mass_from_mc_relation, '200c', '500c', M, solver='newton', workers=workers, chunk_size=max(size//4, 1), **dict(kw, **args))
+        out = np.lib.format.open_memmap(os.path.join(directory, 'out.npy'), mode='w+', dtype=float, shape=(2*size,))
+        checks = {'parallel_call array': np.array_equal(call(np.array(M)), expected), 'parallel_call memmap slice': np.array_equal(call(M), expected)}
+        call(np.array(M), out=out[size:])
+        checks['parallel_call memmap output slice'] = np.array_equal(out[size:], expected) and not np.any(out[:size])
+        del M, out
+        return dict((key, bool(value)) for key, value in checks.items())
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def benchmark(sizes=None, deltas=None, deltas_to=None, solvers=None, reference_size=10000, min_time=0.05, repeat=3, seed=0, log=None):
+    """ times every case of `benchmark_cases` on arrays of `sizes` haloes and compares the first `reference_size` results with the
+        extended precision reference. Returns a dict with the metadata of the run and a list of results that can be saved as JSON
+        and compared with `compare_benchmarks`. Progress is written on `log` (e.g. sys.stderr), if set. """
+    import platform
+    sizes = benchmark_sizes if sizes is None else sizes
+    inputs = benchmark_inputs(max(sizes), seed=seed)
+    reference_inputs = dict((name, value[:reference_size].astype(np.longdouble)) for name, value in inputs.items())
+    results = []
+    for name, delta_from, delta_to, solver, function, reference in benchmark_cases(deltas=deltas, deltas_to=deltas_to, solvers=solvers):
+        function(dict((column, value[:1]) for column, value in inputs.items()))
+        expected = None
+        for size in sizes:
+            kw = dict((column, value[:size]) for column, value in inputs.items())
+            value, seconds = time_call(lambda: function(kw), min_time=min_time, repeat=repeat)
+            n = min(size, reference_size)
+            if expected is None or len(expected)<n:
+                expected = reference(dict((column, value[:n]) for column, value in reference_inputs.items()))
+            value = np.broadcast_to(value, (size,))[:n]
+            error = np.max(np.abs((value - expected[:n])/expected[:n]))
+            result = {'function': name, 'delta_from': delta_from, 'delta_to': delta_to, 'solver': solver, 'size': size, 'seconds': seconds,
+                      'haloes_per_second': size/seconds, 'max_relative_error': float(error), 'sample': value[:4].tolist()}
+            results.append(result)
+            log and log.write('%-30s %-5s %-5s %-18s %9d  %.3e s  %.3e haloes/s  error %.1e\n'%(name, delta_from, delta_to or '', solver or '', size, seconds, size/seconds, error))
+    metadata = {'version': __version__, 'numpy': np.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+                'processor': platform.processor(), 'cpus': os.cpu_count(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seed': seed, 'reference_size': reference_size}
+    checks = check_parallel_call(seed=seed)
+    log and log.write(''.join('%-34s %s\n'%(name, 'ok' if passed else 'FAILED') for name, passed in checks.items()))
+    return {'metadata': metadata, 'results': results, 'checks': checks}
+
+def compare_benchmarks(old, new, time_tolerance=0.25, error_tolerance=2., min_error=1e-13):
+    """ returns a list of the regressions of the benchmark `new` with respect to `old` (both as returned by `benchmark`):
+        cases more than `time_tolerance` slower, with an error larger by more than a factor `error_tolerance` (and larger than `min_error`)
+        or whose results changed by more than their error """
+    key = lambda result: (result['function'], result['delta_from'], result['delta_to'], result['solver'], result['size'])
+    old_results = dict((key(result), result) for result in old['results'])
+    regressions = ['%s: results differ from the serial call'%name for name, passed in new.get('checks', {}).items() if not passed]
+    for result in new['results']:
+        previous = old_results.get(key(result))
+        if previous is None:
+            continue
+        name = '%s %s->%s solver=%s size=%d'%key(result)
+        if result['seconds'] > previous['seconds']*(1.+time_tolerance):
+            regressions.append('%s: slower, %.3e s instead of %.3e s'%(name, result['seconds'], previous['seconds']))
+        if result['max_relative_error'] > max(previous['max_relative_error']*error_tolerance, min_error):
+            regressions.append('%s: less accurate, error %.3e instead of %.3e'%(name, result['max_relative_error'], previous['max_relative_error']))
+        tolerance = max(10.*max(result['max_relative_error'], previous['max_relative_error']), min_error)
+        changes = [abs(x-y)/abs(y) for x, y in zip(result['sample'], previous['sample']) if y!=0.]
+        if changes and max(changes) > tolerance:
+            regressions.append('%s: results changed by %.3e'%(name, max(changes)))
+    return regressions
+
+def run_benchmark(args):
+    """ runs `benchmark` for the command line --benchmark, writes the results as JSON in --output (or stdout) and exits with an error
+        if a check fails or if there are regressions with respect to --benchmark-compare """
+    results = benchmark(sizes=args.benchmark_sizes, deltas=[args.delta1] if args.delta1 else None, deltas_to=[args.delta2] if args.delta2 else None,
+                        solvers=[args.solver] if args.__dict__.get('solver') else None, log=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    else:
+        printf(json.dumps(results, indent=1))
+    failed = [name for name, passed in results['checks'].items() if not passed]
+    failed and panic('Failed checks: %s'%', '.join(failed))
+    if args.benchmark_compare:
+        with open(args.benchmark_compare) as f:
+            regressions = compare_benchmarks(json.load(f), results)
+        for regression in regressions:
+            sys.stderr.write('Regression: %s\n'%regression)
+        regressions and panic('%d regressions with respect to %s'%(len(regressions), args.benchmark_compare))
+        sys.stderr.write('No regressions with respect to %s\n'%args.benchmark_compare)
+
+def argument_parser():
     parser = argparse.ArgumentParser(description='Magneticum Cosmological Masses and Concentration Converter')
     parser.add_argument('--delta1','--delta', type=str, help='Overdensity Delta for the MC relation', default=None)
     parser.add_argument('--delta2', type=str,help='Destination overdensity in case of mass-mass or concentration-concentration conversion', default=None)
@@ -269,15 +1783,54 @@ def main():
 
     parser.add_argument('--mass-from-mc-relation', action='store_true', default=False,help='Computes mass in --delta2 given a MC relation and mass in --delta1.' )
     parser.add_argument('--mass-from-mm-relation', action='store_true', default=False,help='Computes mass in --delta2 given a mass in --delta1 using Ragagnin et al. 2020 MM relation.' )
+    parser.add_argument('--inverse', action='store_true', default=False, help='With --mass-from-mc-relation or --mass-from-mm-relation, --M is the mass in --delta2 and returns the mass in --delta1')
     parser.add_argument('--mass-from-mass-and-c', action='store_true', default=False,help=' Computes mass in --delta2 given a mass and a concentration (use --c) in --delta1')
 
+    parser.add_argument('--solver', type=str, default=None, choices=['banach_caccioppoli','newton','table'], help='Solver of the NFW concentration equation: the fixed point iteration "banach_caccioppoli", the per-element safeguarded "newton" solver or the interpolation of a precomputed NFW "table"')
+    parser.add_argument('--dtype', type=str, default=None, choices=['float64','float32'], help='Floating point type of the conversions, float32 is faster and uses less memory with a relative accuracy of about 1e-6 (see README.md)')
+    parser.add_argument('--all-deltas', action='store_true', default=False, help='Computes mass and concentration in all overdensities 200c, 500c, 2500c, vir and 200m given a mass in --delta1 and either the MC relation or its concentration (use --c)')
     parser.add_argument('--concentration-hu-kratsov-2002', action='store_true', default=False,help=' Computes concetatrion using Hu & Kratsov (2002) fit in Appendix B.')
         
+    parser.add_argument('--catalog', type=str, default=None, help='Convert all haloes of a catalog file (.csv with a header line, .npy structured array, .npz or .hdf5 with one dataset per column). Columns can be M, a, omega_m, omega_b, sigma8, h0 and c, missing columns are taken from the command line (e.g. --omega-m)')
+    parser.add_argument('--output', type=str, default=None, help='Output file of --catalog (.csv, .npy or .hdf5)')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='Number of haloes of --catalog converted at once')
+    parser.add_argument('--serve', action='store_true', default=False, help='Keep running and answer JSON-lines requests from stdin (and from --serve-socket, if set), see README.md')
+    parser.add_argument('--serve-socket', type=str, default=None, help='Path of a Unix socket where to answer JSON-lines requests, implies --serve')
+    parser.add_argument('--benchmark', action='store_true', default=False, help='Time all conversions over --benchmark-sizes haloes and all overdensities (or only --delta1, --delta2 and --solver, if set), check them against a high precision solution and write the results as JSON in --output')
+    parser.add_argument('--benchmark-sizes', type=int, nargs='+', default=None, help='Numbers of haloes of --benchmark, by default 1, 10, ..., 10^7')
+    parser.add_argument('--benchmark-compare', type=str, default=None, help='JSON results of a previous --benchmark, exits with an error in case of regressions of speed or accuracy')
+    parser.add_argument('--profile', action='store_true', default=False, help='At the end, print on stderr the calls, time, solver iterations, unconverged elements, worst residual and range of concentrations of each conversion and solver')
     parser.add_argument('--debug', action='store_true', default=False,help='Show full stacktrace in case of error')
+    return parser
+
+def fit_table_from_args(args):
+    table = {"pivots":{}, "params":[]}
+    args.personalise_fit_parameters  and set_fit_parameters(table, **args.__dict__)
+    if table=={"pivots":{}, "params":[]}:
+        table=None
+    return table
 
+def main():
+    parser = argument_parser()
     args = parser.parse_args()
+    if not args.profile:
+        return run(parser, args)
+    with profiling() as stats:
+        try:
+            run(parser, args)
+        finally:
+            sys.stderr.write(profile_summary(stats))
+
+def run(parser, args):
+    if args.serve or args.serve_socket:
+        serve(stdin=args.serve, socket_path=args.serve_socket)
+        return
     args.personalise_fit_parameters=False;
+    args.solver is None and args.__dict__.pop('solver')
     try:
+        if args.benchmark:
+            run_benchmark(args)
+            return
         if args.set_pivots:
             split_kv(args.set_pivots,args.__dict__,__fit_pivot_names, prekey='pivot_')
             args.personalise_fit_parameters=True
@@ -285,23 +1838,29 @@ def main():
                 split_kv(args.set_fit_parameters,args.__dict__,__fit_parameter_names)
 
 
-        not args.personalise_fit_parameters  and not args.show_fit_parameters  and not args.concentration_from_mc_relation  and not args.concentration_from_c  and not args.mass_from_mm_relation and not args.mass_from_mc_relation and not args.mass_from_mass_and_c and parser.print_help()
-        args.personalise_fit_parameters and not (args.concentration_from_mc_relation or args.mass_from_mc_relation or args.mass_from_mm_relation) and panic("Use --personalise-fit-parameters only in combination with --concentration-from-mc-relation or --mass-from-mc-relation or --mass-from-mm-relation")
-        not args.personalise_fit_parameters and (args.concentration_from_mc_relation  or  args.mass_from_mc_relation  or args.mass_from_mm_relation  ) and (args.M is None or args.a is None or args.omega_m is None or args.omega_b is None or args.sigma8 is None or args.h0 is None) and  panic("If you use  --concentration-from-mc-relation or --mass-from-mc-relation or --mass-from-mm-relation then you must set --M --a --omega-m --omega-b --sigma8 and --h0")
-        args.mass_from_mass_and_c and args.c is None and panic('With --mass_from_mass_and_c you must set also the concentration in delta1 via --c')
+        not args.personalise_fit_parameters  and not args.show_fit_parameters  and not args.concentration_from_mc_relation  and not args.concentration_from_c  and not args.mass_from_mm_relation and not args.mass_from_mc_relation and not args.mass_from_mass_and_c and not args.all_deltas and parser.print_help()
+        args.personalise_fit_parameters and not (args.concentration_from_mc_relation or args.mass_from_mc_relation or args.mass_from_mm_relation or args.all_deltas) and panic("Use --personalise-fit-parameters only in combination with --concentration-from-mc-relation or --mass-from-mc-relation or --mass-from-mm-relation")
+        not args.catalog and not args.personalise_fit_parameters and (args.concentration_from_mc_relation  or  args.mass_from_mc_relation  or args.mass_from_mm_relation  ) and (args.M is None or args.a is None or args.omega_m is None or args.omega_b is None or args.sigma8 is None or args.h0 is None) and  panic("If you use  --concentration-from-mc-relation or --mass-from-mc-relation or --mass-from-mm-relation then you must set --M --a --omega-m --omega-b --sigma8 and --h0")
+        not args.catalog and args.all_deltas and (args.M is None or args.a is None or args.omega_m is None) and panic('With --all-deltas you must set --M, --a and --omega-m')
+        not args.catalog and args.all_deltas and args.c is None and not args.personalise_fit_parameters and (args.omega_b is None or args.sigma8 is None or args.h0 is None) and panic('With --all-deltas and no --c you must set --omega-b, --sigma8 and --h0')
+        not args.catalog and args.mass_from_mass_and_c and args.c is None and panic('With --mass_from_mass_and_c you must set also the concentration in delta1 via --c')
 
 
         
-        table = {"pivots":{}, "params":[]}
-        args.personalise_fit_parameters  and set_fit_parameters(table, **args.__dict__)  and set_pivots(table, **args.__dict__)
-        if table=={"pivots":{}, "params":[]}:
-            table=None
-        args.table = table
+        args.table = fit_table_from_args(args)
+        if args.catalog:
+            convert_catalog(args)
+            return
         args.concentration_from_mc_relation and  printf('c_%s = %.3f'%(args.delta1, concentration_from_mc_relation(args.delta1, **args.__dict__)))
         args.concentration_from_c and  printf('c_%s = %.3f'%(args.delta2, convert_concentration(args.delta1, args.delta2, args.c, **args.__dict__)))
-        args.mass_from_mm_relation and  printf('M_%s = %.3e'%(args.delta2, mass_from_mm_relation(args.delta1, args.delta2,  **args.__dict__)))
-        args.mass_from_mc_relation and  printf('M_%s = %.3e'%(args.delta2, mass_from_mc_relation(args.delta1, args.delta2,  **args.__dict__)))
-        args.mass_from_mass_and_c and  printf('M_%s = %.3e'%(args.delta2, mass_from_m_and_c(args.delta1, args.delta2,  **args.__dict__)))
+        args.mass_from_mm_relation and not args.inverse and  printf('M_%s = %.3e'%(args.delta2, mass_from_mm_relation(args.delta1, args.delta2,  **args.__dict__)))
+        args.mass_from_mc_relation and not args.inverse and  printf('M_%s = %.3e'%(args.delta2, mass_from_mc_relation(args.delta1, args.delta2,  **args.__dict__)))
+        args.mass_from_mm_relation and args.inverse and  printf('M_%s = %.3e'%(args.delta1, inverse_mass_from_mm_relation(args.delta1, args.delta2,  **args.__dict__)))
+        args.mass_from_mc_relation and args.inverse and  printf('M_%s = %.3e'%(args.delta1, inverse_mass_from_mc_relation(args.delta1, args.delta2,  **args.__dict__)))
+        if args.all_deltas:
+            for delta, (M, c) in convert_all_deltas(args.delta1, **args.__dict__).items():
+                printf('M_%s = %.3e  c_%s = %.3f'%(delta, M, delta, c))
+        args.mass_from_mass_and_c and  printf('M_%s = %.3e'%(args.delta2, mass_from_m_and_c(args.delta1, args.delta2, args.c, **args.__dict__)))
     except  Exception as e:
         if args.debug:
             raise 